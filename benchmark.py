@@ -0,0 +1,172 @@
+import argparse
+import json
+import pickle
+import random
+import sys
+import time
+
+import telebot
+from psycopg2 import sql
+from telebot import Handler
+
+from bot import DB, Place, HAS_PHOTO_BLOB, add_save_in_database_step, create_temporary_reply_keyboard, \
+    decode_step, encode_step, get_distance_meters, get_distances_meters
+
+UPDATE_JSON = json.dumps({
+    'update_id': 123456789,
+    'message': {
+        'message_id': 42,
+        'date': 1600000000,
+        'from': {'id': 1001, 'is_bot': False, 'first_name': 'Ivan', 'language_code': 'ru'},
+        'chat': {'id': 1001, 'type': 'private', 'first_name': 'Ivan'},
+        'location': {'latitude': 55.751244, 'longitude': 37.618423},
+    },
+})
+
+
+class NullCursor:
+    def execute(self, query, values=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+class NullConnection:
+    encoding = 'UTF8'
+    prepared = None
+
+
+class CachingCursor(NullCursor):
+    connection = NullConnection()
+
+
+def prime(funcs):
+    quote_ident = sql.ext.quote_ident
+    sql.ext.quote_ident = lambda name, scope: '"' + name.replace('"', '""') + '"'
+    try:
+        for func in funcs:
+            func()
+    finally:
+        sql.ext.quote_ident = quote_ident
+
+
+def measure(func, min_time, repeat):
+    func()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return {'seconds_per_op': best, 'ops_per_second': 1 / best if best else float('inf')}
+
+
+def benchmarks():
+    rnd = random.Random(0)
+    latitudes = [rnd.uniform(-85.0, 85.0) for _ in range(1000)]
+    longitudes = [rnd.uniform(-180.0, 180.0) for _ in range(1000)]
+    titles = [f'{i + 1} Место номер {i}' for i in range(1000)]
+    cur = NullCursor()
+    cached_cur = CachingCursor()
+
+    place = Place(1001, 'Ivan', 'Красная площадь')
+    place.photo_file_id = 'AgACAgIAAxkBAAIBY2Bx' * 3
+    place.latitude, place.longitude = 55.753930, 37.620795
+    handler = Handler(add_save_in_database_step, place=place)
+    state = encode_step(handler)
+
+    queries = {
+        'db_select': lambda cur: DB.select(cur, table_name='places',
+                                           fields_list=['id', 'title', 'photo_file_id', HAS_PHOTO_BLOB, 'latitude', 'longitude'],
+                                           cond_field_list=['user_id'], cond_value_list=[1001],
+                                           order_field='id', reverse_order=True, limit=10),
+        'db_insert': lambda cur: DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'],
+                                           values_list=[1001, 'Ivan'], conflict_field_list=['user_id']),
+        'db_select_page': lambda cur: DB.select_page(cur, table_name='places', fields_list=['id', 'title'],
+                                                     key_field='id', cond_field_list=['user_id'],
+                                                     cond_value_list=[1001], after=500, limit=11),
+    }
+    prime([lambda query=query: query(cached_cur) for query in queries.values()])
+
+    return {
+        'distance_scalar': lambda: get_distance_meters(55.75, 37.61, 59.93, 30.33),
+        'distance_scalar_1000': lambda: [get_distance_meters(lat, long, 55.75, 37.61)
+                                         for lat, long in zip(latitudes, longitudes)],
+        'distance_batch_1000': lambda: get_distances_meters(latitudes, longitudes, 55.75, 37.61),
+        **{name + '_compose': lambda query=query: query(cur) for name, query in queries.items()},
+        **{name + '_cached': lambda query=query: query(cached_cur) for name, query in queries.items()},
+        'reply_keyboard_1000': lambda: create_temporary_reply_keyboard(*titles).to_json(),
+        'update_de_json': lambda: telebot.types.Update.de_json(UPDATE_JSON),
+        'step_state_encode': lambda: encode_step(handler),
+        'step_state_decode': lambda: decode_step(state),
+        'step_state_pickle': lambda: pickle.dumps({1001: [handler]}),
+    }, {
+        'step_state_size_bytes': len(state.encode('utf-8')),
+        'step_state_pickle_size_bytes': len(pickle.dumps({1001: [handler]})),
+    }
+
+
+def run(selected, min_time, repeat):
+    funcs, sizes = benchmarks()
+    results = {}
+    for name, func in funcs.items():
+        if selected and name not in selected:
+            continue
+        results[name] = measure(func, min_time, repeat)
+    for name, size in sizes.items():
+        if not selected or name in selected:
+            results[name] = {'bytes': size}
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if 'seconds_per_op' in result:
+            ratio = result['seconds_per_op'] / base['seconds_per_op']
+        else:
+            ratio = result['bytes'] / base['bytes'] if base['bytes'] else 1.0
+        result['baseline_ratio'] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline micro-benchmarks for bot internals')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (all by default)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimal measured time per round, s')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--baseline', help='Compare with results JSON saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown treated as a regression when comparing')
+    args = parser.parse_args()
+
+    results = run(args.names, args.min_time, args.repeat)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    print(output)
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import argparse
+import random
+import time
+
+from bot import get_distance_meters, get_distances_meters, get_nearest_indexes, PlaceVectors
+
+
+def generate_points(count, seed=0):
+    rnd = random.Random(seed)
+    latitudes = [rnd.uniform(-85.0, 85.0) for _ in range(count)]
+    longitudes = [rnd.uniform(-180.0, 180.0) for _ in range(count)]
+    return latitudes, longitudes
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(sizes, repeat, k):
+    latitude, longitude = 55.751244, 37.618423
+    print(f'{"points":>10} {"scalar, s":>12} {"batch, s":>12} {"vectors, s":>12} {"top-k, s":>12} {"speedup":>10}')
+    for size in sizes:
+        latitudes, longitudes = generate_points(size)
+        vectors = PlaceVectors(latitudes, longitudes)
+
+        scalar = measure(lambda: [get_distance_meters(lat, long, latitude, longitude)
+                                  for lat, long in zip(latitudes, longitudes)], repeat)
+        batch = measure(lambda: get_distances_meters(latitudes, longitudes, latitude, longitude), repeat)
+        precomputed = measure(lambda: vectors.distances_meters(latitude, longitude), repeat)
+        distances = vectors.distances_meters(latitude, longitude)
+        top_k = measure(lambda: get_nearest_indexes(distances, k=k), repeat)
+
+        print(f'{size:>10} {scalar:>12.6f} {batch:>12.6f} {precomputed:>12.6f} {top_k:>12.6f} {scalar / precomputed:>9.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scalar vs batch distance benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat, args.k)
@@ -1,13 +1,43 @@
+import time
+MODULE_LOAD_STARTED = time.perf_counter()
+
 import telebot
+import requests
 import math
+import importlib
+import logging
+import threading
+import abc
+import collections
+import itertools
+import contextlib
+import functools
+import hashlib
+import concurrent.futures
+import re
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2 import sql
-from telebot.types import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from telebot import apihelper
+from telebot.handler_backends import HandlerBackend
+from telebot import Handler
+from telebot.types import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InputMediaPhoto
+from telebot.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 
 from bot_settings import *
+import schema
 
 import os
-from flask import Flask, request
+import io
+import csv
+import json
+import tempfile
+import xml.etree.ElementTree
+import xml.sax.saxutils
+import queue
+import sqlite3
+from flask import Flask, request, Response
 
 WELCOME_MESSAGE = """
 Привет. Я бот гео заметок. Я помогу тебе сохранить и запомнить самые важные и интересные места.
@@ -15,6 +45,7 @@ WELCOME_MESSAGE = """
 """
 
 ERROR_MESSAGE = "Что-то пошло не так :("
+SLOW_DOWN_MESSAGE = "Слишком много запросов, попробуйте чуть позже"
 
 COMMANDS_DESCRIPTION = """
 Список команд:
@@ -22,21 +53,727 @@ COMMANDS_DESCRIPTION = """
 /start - Вывести приветственное сообщение
 /help - Вывести список доступных команд
 /add - Добавить новое место
-/list [size] - Просмотреть список из последних сохраненных мест (по умолчанию 10 мест). Необязательный параметр size отвечает за размер списка
+/list [size] - Просмотреть список из последних сохраненных мест (по умолчанию 10 мест на странице). Необязательный параметр size отвечает за размер страницы (не более 50)
 /reset_all - Удалить все данные пользователя
 /settings - Изменить пользовательские настройки
-/search - Поиск места по названию
+/search - Поиск места по названию (часть названия или название с опечатками)
 /delete - Удаление места по названию
 /add_friend - Добавить контакт друга
 /delete_friend - Удалить друга
+/export [csv|geojson|gpx] - Выгрузить все места в файл
+/import - Загрузить места из файла CSV, GeoJSON или GPX
 
-При отправке координат будет выдан список мест в заданном радиусе (по умолчанию 500 метров)
+При отправке координат будет выдан список мест в заданном радиусе (по умолчанию 500 метров) или, если в настройках задано количество ближайших мест, N ближайших мест (с необязательным ограничением расстояния)
 """
 
-bot = telebot.TeleBot(TOKEN)
+EARTH_RADIUS_M = 6371009
+
+HAS_PHOTO_BLOB = sql.SQL('(photo IS NOT NULL OR photo_hash IS NOT NULL)')
+
+SEARCH_RESULTS_TITLE = 'Результаты поиска: '
+SEARCH_QUERY_MAX_LENGTH = 100
+
+MESSAGE_MAX_LENGTH = 4096
+MEDIA_GROUP_SIZE = 10
+
+logger = logging.getLogger('geo_note_bot')
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule('numpy')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._values[labels] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{format_labels(self.label_names, labels)}}} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._counts = {}
+        self._sums = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[labels] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, counts in sorted(self._counts.items()):
+                label_text = format_labels(self.label_names, labels)
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {counts[-1]}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {self._sums[labels]}')
+                lines.append(f'{self.name}_count{{{label_text}}} {counts[-1]}')
+        return lines
+
+
+def format_labels(label_names, labels):
+    return ','.join(f'{name}="{value}"' for name, value in zip(label_names, labels))
+
+
+handler_duration = Histogram('bot_handler_duration_seconds', 'Handler and next step latency', ['handler'])
+handler_errors = Counter('bot_handler_errors_total', 'Handlers that failed or hit a database/API error', ['handler'])
+db_query_duration = Histogram('bot_db_query_duration_seconds', 'DB query latency', ['operation', 'table'])
+db_query_errors = Counter('bot_db_query_errors_total', 'Failed DB queries', ['operation', 'table'])
+api_request_duration = Histogram('bot_api_request_duration_seconds', 'Telegram Bot API request latency', ['method'])
+api_request_errors = Counter('bot_api_request_errors_total', 'Failed Telegram Bot API requests', ['method'])
+
+handler_context = threading.local()
+
+
+def mark_handler_failed():
+    handler_context.failed = True
+
+
+class InstrumentedTeleBot(telebot.TeleBot):
+    def _exec_task(self, task, *args, **kwargs):
+        name = getattr(task, '__name__', 'unknown')
+        event = args[0] if args else None
+        user_id = event.from_user.id if getattr(event, 'from_user', None) else None
+        step = name in CONVERSATION_STEPS
+        with admission_control.admit(name, user_id, step=step) as admitted:
+            if not admitted:
+                if step:
+                    self._shed_step(task, *args, **kwargs)
+                else:
+                    self._shed(event, user_id)
+                return
+            return self._exec_timed_task(name, task, *args, **kwargs)
+
+    def _exec_timed_task(self, name, task, *args, **kwargs):
+        handler_context.failed = False
+        start = time.perf_counter()
+        try:
+            return super()._exec_task(task, *args, **kwargs)
+        except Exception:
+            handler_context.failed = True
+            raise
+        finally:
+            handler_duration.observe((name,), time.perf_counter() - start)
+            if handler_context.failed:
+                handler_errors.inc((name,))
+
+    def _shed(self, event, user_id):
+        try:
+            if isinstance(event, CallbackQuery):
+                self.answer_callback_query(event.id, SLOW_DOWN_MESSAGE)
+            elif user_id is not None and admission_control.should_notify(user_id):
+                self.send_message(user_id, SLOW_DOWN_MESSAGE)
+        except Exception:
+            pass
+
+    def _shed_step(self, task, message, *args, **kwargs):
+        try:
+            self.register_next_step_handler_by_chat_id(message.chat.id, task, *args, **kwargs)
+            self.send_message(message.chat.id, SLOW_DOWN_MESSAGE + ', отправьте сообщение еще раз')
+        except Exception:
+            pass
+
+
+def timed_query(operation, table=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            table_name = table or kwargs.get('table_name') or (args[2] if len(args) > 2 else 'unknown')
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                db_query_errors.inc((operation, table_name))
+                mark_handler_failed()
+                raise
+            finally:
+                db_query_duration.observe((operation, table_name), time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+bot = InstrumentedTeleBot(TOKEN, threaded=False)
 server = Flask(__name__)
 
 
+class ConnectionPool:
+    def __init__(self, connect, min_size, max_size, timeout, health_check_interval):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = collections.deque()
+        self._cond = threading.Condition()
+        self._size = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.broken = 0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def getconn(self):
+        start = time.monotonic()
+        with self._cond:
+            if not self._idle and self._size >= self.max_size:
+                self.waits += 1
+                deadline = start + self.timeout
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise psycopg2.pool.PoolError('connection pool exhausted')
+                    self._cond.wait(remaining)
+            if self._idle:
+                con, released_at = self._idle.pop()
+            else:
+                con, released_at = None, None
+                self._size += 1
+            self.in_use += 1
+
+        try:
+            if con is not None and not self._is_healthy(con, released_at):
+                self._discard(con)
+                con = None
+            if con is None:
+                con = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self.checkouts += 1
+            self.checkout_time_total += elapsed
+            self.checkout_time_max = max(self.checkout_time_max, elapsed)
+        return con
+
+    def putconn(self, con, close=False):
+        if not close and not con.closed:
+            try:
+                if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    con.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or con.closed:
+            self._discard(con)
+            with self._cond:
+                self._size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((con, time.monotonic()))
+            self.in_use -= 1
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                con, _ = self._idle.pop()
+                self._discard(con)
+                self._size -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'broken': self.broken,
+                'checkout_time_avg': self.checkout_time_total / self.checkouts if self.checkouts else 0.0,
+                'checkout_time_max': self.checkout_time_max,
+            }
+
+    def _is_healthy(self, con, released_at):
+        if con.closed:
+            self.broken += 1
+            return False
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            with con.cursor() as cur:
+                cur.execute('SELECT 1')
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            self.broken += 1
+            return False
+
+    @staticmethod
+    def _discard(con):
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def add(self, key, value=True):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                return False
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return True
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def take(self, cost=1):
+        with self._lock:
+            self._refill()
+            if self._tokens < cost:
+                return False
+            self._tokens -= cost
+            return True
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens +
+                           (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+
+class AdmissionControl:
+    def __init__(self, rate, burst, costs, default_cost, heavy_handlers, heavy_limit, heavy_timeout,
+                 notice_interval):
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+        self.default_cost = default_cost
+        self.heavy_handlers = heavy_handlers
+        self.heavy_limit = heavy_limit
+        self.heavy_timeout = heavy_timeout
+        self._buckets = TTLCache(max_size=USER_CACHE_SIZE, ttl=burst / rate)
+        self._notices = TTLCache(max_size=USER_CACHE_SIZE, ttl=notice_interval)
+        self._heavy = threading.BoundedSemaphore(heavy_limit)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.shed_rate = 0
+        self.shed_busy = 0
+        self.heavy_active = 0
+
+    @contextlib.contextmanager
+    def admit(self, handler, user_id, step=False):
+        if not step and user_id is not None and not self._take(user_id, self.costs.get(handler, self.default_cost)):
+            self._count('shed_rate')
+            yield False
+            return
+        if handler not in self.heavy_handlers:
+            self._count('admitted')
+            yield True
+            return
+        if not self._heavy.acquire(timeout=self.heavy_timeout):
+            self._count('shed_busy')
+            yield False
+            return
+        with self._lock:
+            self.admitted += 1
+            self.heavy_active += 1
+        try:
+            yield True
+        finally:
+            with self._lock:
+                self.heavy_active -= 1
+            self._heavy.release()
+
+    def should_notify(self, user_id):
+        return self._notices.add(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {'admitted': self.admitted, 'shed_rate': self.shed_rate, 'shed_busy': self.shed_busy,
+                    'heavy_active': self.heavy_active, 'heavy_limit': self.heavy_limit}
+
+    def _take(self, user_id, cost):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.set(user_id, bucket)
+        return bucket.take(cost)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+class SendPipeline:
+    def __init__(self, make_request, global_rate, chat_rate, chat_burst, group_rate, max_retries):
+        self._make_request = make_request
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = TTLCache(max_size=10000, ttl=60.0)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.throttle_time = 0.0
+        self.retries = 0
+
+    def make_request(self, token, method_name, method='get', params=None, files=None):
+        if method_name.startswith('send') and params:
+            self._throttle(params.get('chat_id'))
+        attempt = 0
+        while True:
+            with self._lock:
+                self.requests += 1
+            start = time.perf_counter()
+            try:
+                return self._make_request(token, method_name, method=method,
+                                          params=dict(params) if params else params, files=files)
+            except Exception as err:
+                api_request_errors.inc((method_name,))
+                retry_after = get_retry_after(err) if isinstance(err, apihelper.ApiException) else None
+                if retry_after is None:
+                    mark_handler_failed()
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                time.sleep(retry_after)
+            finally:
+                api_request_duration.observe((method_name,), time.perf_counter() - start)
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled,
+                    'throttle_time': self.throttle_time, 'retries': self.retries}
+
+    def _throttle(self, chat_id):
+        delay = self._global_bucket.reserve()
+        if chat_id is not None:
+            with self._lock:
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is None:
+                    if int(chat_id) < 0:
+                        bucket = TokenBucket(self.group_rate, 1)
+                    else:
+                        bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets.set(chat_id, bucket)
+            delay = max(delay, bucket.reserve())
+        if delay > 0:
+            with self._lock:
+                self.throttled += 1
+                self.throttle_time += delay
+            time.sleep(delay)
+
+
+def get_retry_after(err):
+    result = err.result
+    if result is None or result.status_code != 429:
+        return None
+    try:
+        return result.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+admission_control = AdmissionControl(rate=ADMISSION_RATE,
+                                     burst=ADMISSION_BURST,
+                                     costs=ADMISSION_COSTS,
+                                     default_cost=ADMISSION_DEFAULT_COST,
+                                     heavy_handlers=ADMISSION_HEAVY_HANDLERS,
+                                     heavy_limit=ADMISSION_HEAVY_LIMIT,
+                                     heavy_timeout=ADMISSION_HEAVY_TIMEOUT,
+                                     notice_interval=ADMISSION_NOTICE_INTERVAL)
+send_pipeline = SendPipeline(apihelper._make_request,
+                             global_rate=SEND_GLOBAL_RATE,
+                             chat_rate=SEND_CHAT_RATE,
+                             chat_burst=SEND_CHAT_BURST,
+                             group_rate=SEND_GROUP_RATE,
+                             max_retries=SEND_MAX_RETRIES)
+apihelper._make_request = send_pipeline.make_request
+apihelper.session = requests.Session()
+apihelper.session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=SEND_HTTP_POOL_SIZE))
+
+
+class UpdateDispatcher:
+    def __init__(self, process, workers, queue_size, put_timeout):
+        self._process = process
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.last_lag = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for worker_queue in self._queues:
+                thread = threading.Thread(
+                    target=self._run, args=(worker_queue,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, update):
+        self.start()
+        key = get_update_user_id(update)
+        worker_queue = self._queues[hash(key) % self.workers]
+        try:
+            worker_queue.put((update, time.monotonic()), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            update, enqueued_at = worker_queue.get()
+            lag = time.monotonic() - enqueued_at
+            with self._lock:
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+                self.last_lag = lag
+            try:
+                self._process([update])
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.processed += 1
+                worker_queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            depths = [worker_queue.qsize() for worker_queue in self._queues]
+            return {
+                'workers': self.workers,
+                'queue_depth': sum(depths),
+                'queue_depth_max': max(depths),
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'lag_avg': self.lag_total / self.processed if self.processed else 0.0,
+                'lag_max': self.lag_max,
+                'lag_last': self.last_lag,
+            }
+
+
+class UpdateDeduplicator:
+    def __init__(self, max_size, ttl, persistent=False, cleanup_every=1000):
+        self.ttl = ttl
+        self.persistent = persistent
+        self.cleanup_every = cleanup_every
+        self._seen = TTLCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._registered = 0
+        self.duplicates = 0
+
+    def register(self, update_id):
+        if not self._seen.add(update_id):
+            self._count_duplicate()
+            return False
+        if self.persistent and not self._register_persistent(update_id):
+            self._count_duplicate()
+            return False
+        return True
+
+    def forget(self, update_id):
+        self._seen.invalidate(update_id)
+        if not self.persistent:
+            return
+        try:
+            with DB.connection() as con:
+                cur = con.cursor()
+                DB.delete(cur, table_name='processed_updates', cond_field_list=['update_id'],
+                          cond_value_list=[update_id])
+        except psycopg2.Error:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {'duplicates': self.duplicates, **self._seen.stats()}
+
+    def _count_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def _register_persistent(self, update_id):
+        with self._lock:
+            self._registered += 1
+            cleanup = self._registered % self.cleanup_every == 0
+        try:
+            with DB.connection() as con:
+                cur = con.cursor()
+                DB.insert(cur, table_name='processed_updates', fields_list=['update_id'],
+                          values_list=[update_id], conflict_field_list=['update_id'])
+                inserted = cur.rowcount == 1
+                if cleanup:
+                    cur.execute("DELETE FROM processed_updates WHERE received_at < now() - %s * interval '1 second'",
+                                (self.ttl,))
+            return inserted
+        except psycopg2.Error:
+            return True
+
+
+def get_update_user_id(update):
+    for event in (update.message, update.edited_message, update.callback_query,
+                  update.inline_query, update.chosen_inline_result):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return update.update_id
+
+
+class PreparedQuery:
+    PARAMETER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.uses = 0
+        parameters = []
+
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                parameters.append('%s')
+                return f'${len(parameters)}'
+            parameter = f'%({match.group(1)})s'
+            if parameter not in parameters:
+                parameters.append(parameter)
+            return f'${parameters.index(parameter) + 1}'
+
+        self.prepare_statement = f'PREPARE {name} AS ' + self.PARAMETER.sub(number, text)
+        self.execute_statement = f'EXECUTE {name}' + (f' ({", ".join(parameters)})' if parameters else '')
+
+
+class ReplicaError(psycopg2.OperationalError):
+    pass
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
 class DB:
     user = USER
     password = PASSWORD
@@ -44,79 +781,421 @@ class DB:
     port = PORT
     database = DATABASE
 
+    replica_dsns = REPLICA_DSNS
+
+    pool = None
+    replica_pools = None
+    _pool_lock = threading.Lock()
+    _replica_lock = threading.Lock()
+    _next_replica = 0
+    _replica_down_until = {}
+    _written = TTLCache(max_size=USER_CACHE_SIZE, ttl=REPLICA_STICKY_TTL)
+    _queries = {}
+    _queries_lock = threading.Lock()
+
     @classmethod
     def connect(cls):
         con = psycopg2.connect(user=cls.user,
                                password=cls.password,
                                host=cls.host,
                                port=cls.port,
-                               database=cls.database)
+                               database=cls.database,
+                               connection_factory=PreparingConnection if DB_PREPARED_STATEMENTS else None)
         return con
 
     @classmethod
-    def insert(cls, cur, table_name, fields_list, values_list, conflict_field_list=None):
-        query = sql.SQL("INSERT INTO {table}({fields}) VALUES({values}) ").format(
-            table=sql.Identifier(table_name),
-            fields=sql.SQL(', ').join(map(sql.Identifier, fields_list)),
-            values=sql.SQL(', ').join(sql.Placeholder() * len(values_list)))
-        if conflict_field_list:
-            query = sql.Composed(
-                [query, sql.SQL("ON CONFLICT ({fields}) DO NOTHING ").format(
-                    fields=sql.SQL(', ').join(map(sql.Identifier, conflict_field_list)))])
-        cur.execute(query, tuple(values_list))
+    def connect_replica(cls, dsn):
+        return psycopg2.connect(dsn, connection_factory=PreparingConnection if DB_PREPARED_STATEMENTS else None)
+
+    @classmethod
+    def get_pool(cls):
+        if cls.pool is None:
+            with cls._pool_lock:
+                if cls.pool is None:
+                    pool = ConnectionPool(cls.connect,
+                                          min_size=POOL_MIN_SIZE,
+                                          max_size=POOL_MAX_SIZE,
+                                          timeout=POOL_CHECKOUT_TIMEOUT,
+                                          health_check_interval=POOL_HEALTH_CHECK_INTERVAL)
+                    con = pool.getconn()
+                    try:
+                        schema.migrate(con)
+                    finally:
+                        pool.putconn(con)
+                    cls.pool = pool
+        return cls.pool
+
+    @classmethod
+    def get_replica_pools(cls):
+        if cls.replica_pools is None:
+            with cls._pool_lock:
+                if cls.replica_pools is None:
+                    cls.replica_pools = [ConnectionPool(functools.partial(cls.connect_replica, dsn),
+                                                        min_size=0,
+                                                        max_size=POOL_MAX_SIZE,
+                                                        timeout=REPLICA_CHECKOUT_TIMEOUT,
+                                                        health_check_interval=POOL_HEALTH_CHECK_INTERVAL)
+                                         for dsn in cls.replica_dsns]
+        return cls.replica_pools
+
+    @classmethod
+    @contextlib.contextmanager
+    def connection(cls, readonly=False, user_id=None):
+        pool, index, con = cls.__checkout(readonly and not cls.is_sticky(user_id))
+        broken = False
+        try:
+            yield con
+            con.commit()
+        except BaseException as err:
+            broken = bool(con.closed) or (isinstance(err, psycopg2.OperationalError) and err.pgcode is None)
+            if not con.closed:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken and index is not None:
+                cls.__mark_replica_down(index)
+                if isinstance(err, psycopg2.Error):
+                    raise ReplicaError(*err.args) from err
+            raise
+        finally:
+            pool.putconn(con, close=broken)
+
+    @classmethod
+    def read(cls, func, user_id=None):
+        try:
+            with cls.connection(readonly=True, user_id=user_id) as con:
+                return func(con)
+        except ReplicaError:
+            with cls.connection() as con:
+                return func(con)
+
+    @classmethod
+    def mark_written(cls, *user_ids):
+        if cls.replica_dsns:
+            for user_id in user_ids:
+                cls._written.set(user_id, True)
+
+    @classmethod
+    def is_sticky(cls, user_id):
+        return user_id is not None and cls._written.get(user_id, False)
+
+    @classmethod
+    def pool_stats(cls):
+        if cls.pool is None:
+            return {}
+        return cls.pool.stats()
+
+    @classmethod
+    def replica_stats(cls):
+        now = time.monotonic()
+        return [dict(pool.stats(), healthy=int(cls._replica_down_until.get(index, 0) <= now))
+                for index, pool in enumerate(cls.replica_pools or [])]
+
+    @classmethod
+    def __checkout(cls, readonly):
+        if readonly and cls.replica_dsns:
+            pools = cls.get_replica_pools()
+            with cls._replica_lock:
+                start = cls._next_replica
+                cls._next_replica = (start + 1) % len(pools)
+            now = time.monotonic()
+            for offset in range(len(pools)):
+                index = (start + offset) % len(pools)
+                if cls._replica_down_until.get(index, 0) > now:
+                    continue
+                try:
+                    return pools[index], index, pools[index].getconn()
+                except psycopg2.pool.PoolError:
+                    continue
+                except psycopg2.OperationalError:
+                    cls.__mark_replica_down(index)
+        pool = cls.get_pool()
+        return pool, None, pool.getconn()
+
+    @classmethod
+    def __mark_replica_down(cls, index):
+        cls._replica_down_until[index] = time.monotonic() + REPLICA_RETRY_INTERVAL
+
+    @classmethod
+    @timed_query('insert')
+    def insert(cls, cur, table_name, fields_list, values_list, conflict_field_list=None, returning_field=None):
+        def build():
+            query = sql.SQL("INSERT INTO {table}({fields}) VALUES({values}) ").format(
+                table=sql.Identifier(table_name),
+                fields=DB.__compose_fields(fields_list),
+                values=sql.SQL(', ').join(sql.Placeholder() * len(values_list)))
+            if conflict_field_list:
+                query = sql.Composed(
+                    [query, sql.SQL("ON CONFLICT ({fields}) DO NOTHING ").format(
+                        fields=sql.SQL(', ').join(map(sql.Identifier, conflict_field_list)))])
+            if returning_field:
+                query = sql.Composed(
+                    [query, sql.SQL("RETURNING {field} ").format(field=sql.Identifier(returning_field))])
+            return query
+        shape = ('insert', table_name, DB.__fields_key(fields_list), len(values_list), tuple(conflict_field_list or ()),
+                 returning_field)
+        DB.__execute(cur, shape, build, tuple(values_list))
 
     @classmethod
+    @timed_query('select')
     def select(cls, cur, table_name, fields_list, cond_field_list=None, cond_value_list=None, order_field=None, reverse_order=False, limit=None):
-        query = sql.SQL("SELECT {fields} FROM {table} ").format(
-            fields=sql.SQL(', ').join(map(sql.Identifier, fields_list)),
-            table=sql.Identifier(table_name)
-        )
-        values = []
-        if cond_field_list and cond_value_list:
+        if not (cond_field_list and cond_value_list):
+            cond_field_list, cond_value_list = [], []
+
+        def build():
+            query = sql.SQL("SELECT {fields} FROM {table} ").format(
+                fields=DB.__compose_fields(fields_list),
+                table=sql.Identifier(table_name)
+            )
             query = DB.__add_conditions(query, cond_field_list)
-            values += cond_value_list
-        if order_field:
-            query = sql.Composed(
-                [query, sql.SQL("ORDER BY {field} ").format(
-                    field=sql.Identifier(order_field))])
-            if reverse_order:
-                query = sql.Composed([query, sql.SQL("DESC ")])
+            if order_field:
+                query = sql.Composed(
+                    [query, sql.SQL("ORDER BY {field} ").format(
+                        field=sql.Identifier(order_field))])
+                if reverse_order:
+                    query = sql.Composed([query, sql.SQL("DESC ")])
+            if limit:
+                query = sql.Composed(
+                    [query, sql.SQL("LIMIT {limit} ").format(limit=sql.Placeholder())])
+            return query
+        values = list(cond_value_list)
         if limit:
-            query = sql.Composed(
-                [query, sql.SQL("LIMIT {limit} ").format(limit=sql.Placeholder())])
             values.append(limit)
-        cur.execute(query, tuple(values))
+        shape = ('select', table_name, DB.__fields_key(fields_list), tuple(cond_field_list),
+                 order_field, bool(order_field and reverse_order), bool(limit))
+        DB.__execute(cur, shape, build, tuple(values))
 
     @classmethod
+    @timed_query('delete')
     def delete(cls, cur, table_name, cond_field_list=None, cond_value_list=None):
-        query = sql.SQL("DELETE FROM {table} ").format(
-            table=sql.Identifier(table_name)
-        )
-        values = []
-        if cond_field_list and cond_value_list:
-            query = DB.__add_conditions(query, cond_field_list)
-            values += cond_value_list
-        cur.execute(query, tuple(values))
+        if not (cond_field_list and cond_value_list):
+            cond_field_list, cond_value_list = [], []
+
+        def build():
+            query = sql.SQL("DELETE FROM {table} ").format(
+                table=sql.Identifier(table_name)
+            )
+            return DB.__add_conditions(query, cond_field_list)
+        shape = ('delete', table_name, tuple(cond_field_list))
+        DB.__execute(cur, shape, build, tuple(cond_value_list))
 
     @classmethod
+    @timed_query('update')
     def update(cls, cur, table_name, field_name, new_value, cond_field_list=None, cond_value_list=None):
-        query = sql.SQL("UPDATE {table} SET {field} = {value} ").format(
-            table=sql.Identifier(table_name),
-            field=sql.Identifier(field_name),
-            value=sql.Placeholder()
-        )
-        values = [new_value]
-        if cond_field_list and cond_value_list:
-            query = DB.__add_conditions(query, cond_field_list)
-            values += cond_value_list
-        cur.execute(query, tuple(values))
+        if not (cond_field_list and cond_value_list):
+            cond_field_list, cond_value_list = [], []
+
+        def build():
+            query = sql.SQL("UPDATE {table} SET {field} = {value} ").format(
+                table=sql.Identifier(table_name),
+                field=sql.Identifier(field_name),
+                value=sql.Placeholder()
+            )
+            return DB.__add_conditions(query, cond_field_list)
+        shape = ('update', table_name, field_name, tuple(cond_field_list))
+        DB.__execute(cur, shape, build, (new_value, *cond_value_list))
 
     @classmethod
-    def __add_conditions(cls, query, cond_field_list):
-        conditions_list = [sql.SQL("{cond_field} = {cond_value}").format(
+    @timed_query('select')
+    def select_page(cls, cur, table_name, fields_list, key_field, cond_field_list=None, cond_value_list=None,
+                    after=None, before=None, limit=None):
+        cond_field_list = list(cond_field_list or [])
+        values = list(cond_value_list or [])
+        operators = ['='] * len(cond_field_list)
+        if after or before:
+            cond_field_list.append(key_field)
+            operators.append('>' if before else '<')
+            values.append(before or after)
+        if limit:
+            values.append(limit)
+
+        def build():
+            query = sql.SQL("SELECT {fields} FROM {table} ").format(
+                fields=DB.__compose_fields(fields_list),
+                table=sql.Identifier(table_name)
+            )
+            query = DB.__add_conditions(query, cond_field_list, operators)
+            query = sql.Composed(
+                [query, sql.SQL("ORDER BY {field} {direction} ").format(
+                    field=sql.Identifier(key_field),
+                    direction=sql.SQL('ASC' if before else 'DESC'))])
+            if limit:
+                query = sql.Composed(
+                    [query, sql.SQL("LIMIT {limit} ").format(limit=sql.Placeholder())])
+            return query
+        shape = ('select_page', table_name, DB.__fields_key(fields_list), key_field,
+                 tuple(cond_field_list), tuple(operators), bool(before), bool(limit))
+        DB.__execute(cur, shape, build, tuple(values))
+        rows = cur.fetchall()
+        if before:
+            rows.reverse()
+        return rows
+
+    @classmethod
+    @timed_query('select', table='places')
+    def select_within_box(cls, cur, fields_list, owner_ids, box):
+        min_latitude, max_latitude, min_longitude, max_longitude = box
+        if min_longitude is None:
+            longitude_mode = None
+        elif min_longitude <= max_longitude:
+            longitude_mode = 'between'
+        else:
+            longitude_mode = 'wrap'
+
+        def build():
+            query = sql.SQL("SELECT {fields} FROM {table} WHERE ").format(
+                fields=DB.__compose_fields(fields_list),
+                table=sql.Identifier('places'))
+            query = sql.Composed([query, sql.SQL("user_id = ANY(%(owner_ids)s) "),
+                                  sql.SQL("AND latitude BETWEEN %(min_latitude)s AND %(max_latitude)s ")])
+            if longitude_mode == 'between':
+                query = sql.Composed(
+                    [query, sql.SQL("AND longitude BETWEEN %(min_longitude)s AND %(max_longitude)s ")])
+            elif longitude_mode == 'wrap':
+                query = sql.Composed(
+                    [query, sql.SQL("AND (longitude >= %(min_longitude)s OR longitude <= %(max_longitude)s) ")])
+            return query
+        shape = ('select_within_box', DB.__fields_key(fields_list), longitude_mode)
+        DB.__execute(cur, shape, build, {'owner_ids': list(owner_ids),
+                                         'min_latitude': min_latitude, 'max_latitude': max_latitude,
+                                         'min_longitude': min_longitude, 'max_longitude': max_longitude})
+
+    @classmethod
+    @timed_query('select', table='places')
+    def select_photo(cls, cur, place_id, thumbnail=False):
+        def build():
+            data = "COALESCE(photos.thumbnail, places.photo, photos.data)" if thumbnail else "COALESCE(places.photo, photos.data)"
+            return sql.SQL("SELECT " + data + " FROM places LEFT JOIN photos ON photos.hash = places.photo_hash "
+                           "WHERE places.id = %(place_id)s ")
+        DB.__execute(cur, ('select_photo', thumbnail), build, {'place_id': place_id})
+
+    @classmethod
+    @timed_query('select', table='places')
+    def select_nearest(cls, cur, fields_list, owner_ids, latitude, longitude, limit, max_radius=None):
+        def build():
+            query = sql.SQL("SELECT nearest.* FROM unnest(%(owner_ids)s::bigint[]) AS owners(user_id) "
+                            "CROSS JOIN LATERAL (SELECT {fields} FROM {table} "
+                            "WHERE places.user_id = owners.user_id AND latitude IS NOT NULL AND longitude IS NOT NULL ").format(
+                fields=DB.__compose_fields(fields_list),
+                table=sql.Identifier('places'))
+            if max_radius:
+                query = sql.Composed(
+                    [query, sql.SQL("AND earth_box(ll_to_earth(%(latitude)s, %(longitude)s), %(max_radius)s) "
+                                    "@> ll_to_earth(latitude, longitude) ")])
+            return sql.Composed(
+                [query, sql.SQL("ORDER BY ll_to_earth(latitude, longitude) <-> ll_to_earth(%(latitude)s, %(longitude)s) "
+                                "LIMIT %(limit)s) AS nearest ")])
+        shape = ('select_nearest', DB.__fields_key(fields_list), bool(max_radius))
+        DB.__execute(cur, shape, build, {'owner_ids': list(owner_ids), 'latitude': latitude, 'longitude': longitude,
+                                         'max_radius': max_radius, 'limit': limit})
+
+    @classmethod
+    @timed_query('select', table='places')
+    def search_titles(cls, cur, owner_ids, text, after=None, before=None, limit=None):
+        values = {'owner_ids': list(owner_ids), 'text': text, 'pattern': '%' + escape_like(text) + '%'}
+        if after:
+            values['rank'], values['id'] = after
+        elif before:
+            values['rank'], values['id'] = before
+        if limit:
+            values['limit'] = limit
+
+        def build():
+            query = sql.SQL("SELECT id, title, word_similarity(%(text)s, title)::float8 AS rank FROM places "
+                            "WHERE user_id = ANY(%(owner_ids)s) AND (%(text)s <%% title OR title ILIKE %(pattern)s) ")
+            if after:
+                query = sql.Composed(
+                    [query, sql.SQL("AND (word_similarity(%(text)s, title)::float8, id) < (%(rank)s::float8, %(id)s) ORDER BY rank DESC, id DESC ")])
+            elif before:
+                query = sql.Composed(
+                    [query, sql.SQL("AND (word_similarity(%(text)s, title)::float8, id) > (%(rank)s::float8, %(id)s) ORDER BY rank, id ")])
+            else:
+                query = sql.Composed([query, sql.SQL("ORDER BY rank DESC, id DESC ")])
+            if limit:
+                query = sql.Composed([query, sql.SQL("LIMIT %(limit)s ")])
+            return query
+        shape = ('search_titles', 'after' if after else 'before' if before else None, bool(limit))
+        DB.__execute(cur, shape, build, values)
+        rows = cur.fetchall()
+        if before:
+            rows.reverse()
+        return rows
+
+    @classmethod
+    @timed_query('select', table='places')
+    def select_visible_place(cls, cur, fields_list, owner_ids, place_id):
+        def build():
+            return sql.SQL("SELECT {fields} FROM {table} WHERE id = %(place_id)s AND user_id = ANY(%(owner_ids)s) ").format(
+                fields=DB.__compose_fields(fields_list),
+                table=sql.Identifier('places'))
+        shape = ('select_visible_place', DB.__fields_key(fields_list))
+        DB.__execute(cur, shape, build, {'place_id': place_id, 'owner_ids': list(owner_ids)})
+
+    @classmethod
+    @timed_query('copy', table='places')
+    def copy_places_to(cls, cur, user_id, file):
+        cur.copy_expert(sql.SQL("COPY (SELECT title, latitude, longitude FROM places WHERE user_id = {user_id} ORDER BY id) "
+                                "TO STDOUT WITH (FORMAT csv, HEADER, ENCODING 'UTF8')").format(user_id=sql.Literal(user_id)), file)
+
+    @classmethod
+    @timed_query('copy', table='places')
+    def copy_places_from(cls, cur, user_id, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for title, latitude, longitude in rows:
+            writer.writerow([user_id, title, latitude, longitude])
+        buffer.seek(0)
+        cur.copy_expert("COPY places (user_id, title, latitude, longitude) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    @classmethod
+    def query_stats(cls):
+        shapes = list(cls._queries.values())
+        return {'shapes': len(shapes), 'executions': sum(shape.uses for shape in shapes)}
+
+    @classmethod
+    def __execute(cls, cur, shape, build, values):
+        con = getattr(cur, 'connection', None)
+        if con is None:
+            cur.execute(build(), values)
+            return
+        key = (con.encoding, *shape)
+        query = cls._queries.get(key)
+        if query is None:
+            with cls._queries_lock:
+                query = cls._queries.get(key)
+                if query is None:
+                    query = PreparedQuery(f'q{len(cls._queries)}', build().as_string(con))
+                    cls._queries[key] = query
+        query.uses += 1
+        prepared = getattr(con, 'prepared', None)
+        if prepared is None or query.uses < DB_PREPARE_THRESHOLD or getattr(cur, 'name', None):
+            cur.execute(query.text, values)
+            return
+        if query.name not in prepared:
+            cur.execute(query.prepare_statement)
+            prepared.add(query.name)
+        cur.execute(query.execute_statement, values)
+
+    @classmethod
+    def __fields_key(cls, fields_list):
+        return tuple(field if isinstance(field, str) else repr(field) for field in fields_list)
+
+    @classmethod
+    def __compose_fields(cls, fields_list):
+        return sql.SQL(', ').join(
+            field if isinstance(field, sql.Composable) else sql.Identifier(field) for field in fields_list)
+
+    @classmethod
+    def __add_conditions(cls, query, cond_field_list, operators=None):
+        if not cond_field_list:
+            return query
+        operators = operators or ['='] * len(cond_field_list)
+        conditions_list = [sql.SQL("{cond_field} {operator} {cond_value}").format(
             cond_field=sql.Identifier(field),
+            operator=sql.SQL(operator),
             cond_value=sql.Placeholder()
-        ) for field in cond_field_list]
+        ) for field, operator in zip(cond_field_list, operators)]
         query = sql.Composed(
             [query, sql.SQL("WHERE {conditions} ").format(
                 conditions=sql.SQL(' AND ').join(conditions_list)
@@ -125,16 +1204,427 @@ class DB:
         return query
 
 
+UserSettings = collections.namedtuple(
+    'UserSettings', ['list_size', 'radius', 'friend_place_visible', 'nearest_count', 'nearest_max_radius'])
+
+user_settings_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+NOT_CACHED = object()
+
+
+def get_user_settings(user_id):
+    settings = user_settings_cache.get(user_id, NOT_CACHED)
+    if settings is NOT_CACHED:
+        def select(con):
+            cur = con.cursor()
+            DB.select(cur, table_name='users', fields_list=list(UserSettings._fields),
+                      cond_field_list=['user_id'], cond_value_list=[user_id])
+            return cur.fetchone()
+        data = DB.read(select, user_id=user_id)
+        settings = UserSettings(*data) if data else None
+        user_settings_cache.set(user_id, settings)
+    return settings
+
+
+class FriendGraph:
+    def __init__(self, max_size, ttl):
+        self._friends = TTLCache(max_size=max_size, ttl=ttl)
+        self._followers = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get_friends(self, user_id):
+        return self._get(self._friends, 'friend_id', 'user_id', user_id)
+
+    def get_followers(self, user_id):
+        return self._get(self._followers, 'user_id', 'friend_id', user_id)
+
+    def invalidate(self, user_id, friend_id):
+        self._friends.invalidate(user_id)
+        self._followers.invalidate(friend_id)
+
+    def clear(self):
+        self._friends.clear()
+        self._followers.clear()
+
+    def stats(self):
+        return {'friends': self._friends.stats(), 'followers': self._followers.stats()}
+
+    @staticmethod
+    def _get(cache, field, cond_field, user_id):
+        ids = cache.get(user_id)
+        if ids is None:
+            def select(con):
+                cur = con.cursor()
+                DB.select(cur, table_name='friends', fields_list=[field],
+                          cond_field_list=[cond_field], cond_value_list=[user_id])
+                return frozenset(row[0] for row in cur.fetchall())
+            ids = DB.read(select, user_id=user_id)
+            cache.set(user_id, ids)
+        return ids
+
+
+friend_graph = FriendGraph(max_size=FRIEND_CACHE_SIZE, ttl=FRIEND_CACHE_TTL)
+
+
+def get_visible_owner_ids(user_id, settings):
+    if settings and settings.friend_place_visible:
+        return [user_id] + sorted(friend_graph.get_followers(user_id))
+    return [user_id]
+
+
+class PhotoIngest:
+    def __init__(self, workers, thumbnail_width, orphan_ttl, cleanup_interval):
+        self.thumbnail_width = thumbnail_width
+        self.orphan_ttl = orphan_ttl
+        self.cleanup_interval = cleanup_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='photo-ingest')
+        self._lock = threading.Lock()
+        self._cleanup_thread = None
+        self.pending = 0
+        self.ingested = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.removed = 0
+
+    def get_thumbnail(self, photo_sizes):
+        sizes = sorted(photo_sizes, key=lambda size: size.width)
+        return next((size for size in sizes if size.width >= self.thumbnail_width), sizes[-1])
+
+    def attach(self, place_id, file_id, thumbnail_file_id):
+        self._count('pending')
+        job = self._executor.submit(self._ingest, file_id, thumbnail_file_id)
+        job.add_done_callback(functools.partial(self._attach, place_id))
+
+    def start_cleanup(self):
+        with self._lock:
+            if self._cleanup_thread is not None:
+                return
+            self._cleanup_thread = threading.Thread(target=self._run_cleanup, daemon=True)
+            self._cleanup_thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self.pending, 'ingested': self.ingested,
+                    'deduplicated': self.deduplicated, 'failed': self.failed, 'removed': self.removed}
+
+    def _ingest(self, file_id, thumbnail_file_id):
+        try:
+            found = self._touch('file_id', file_id)
+            if found:
+                self._count('deduplicated')
+                return found
+            data = bot.download_file(bot.get_file(file_id).file_path)
+            photo_hash = hashlib.sha256(data).hexdigest()
+            if self._touch('hash', photo_hash):
+                self._count('deduplicated')
+                return photo_hash
+            thumbnail = None
+            if thumbnail_file_id and thumbnail_file_id != file_id:
+                thumbnail = bot.download_file(bot.get_file(thumbnail_file_id).file_path)
+            with DB.connection() as con:
+                cur = con.cursor()
+                DB.insert(cur, table_name='photos', fields_list=['hash', 'file_id', 'data', 'thumbnail'],
+                          values_list=[photo_hash, file_id, data, thumbnail], conflict_field_list=['hash'])
+            self._count('ingested')
+            return photo_hash
+        except Exception:
+            self._count('failed')
+            raise
+        finally:
+            self._count('pending', -1)
+
+    def _attach(self, place_id, job):
+        if job.exception() is not None:
+            return
+        try:
+            with DB.connection() as con:
+                cur = con.cursor()
+                DB.update(cur, table_name='places', field_name='photo_hash', new_value=job.result(),
+                          cond_field_list=['id'], cond_value_list=[place_id])
+        except psycopg2.Error:
+            self._count('failed')
+
+    def _touch(self, field, value):
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql.SQL("UPDATE photos SET created_at = now() WHERE {field} = %s RETURNING hash").format(
+                field=sql.Identifier(field)), (value,))
+            found = cur.fetchone()
+        return found[0] if found else None
+
+    def _run_cleanup(self):
+        while True:
+            time.sleep(self.cleanup_interval)
+            self._cleanup()
+
+    def _cleanup(self):
+        try:
+            with DB.connection() as con:
+                cur = con.cursor()
+                cur.execute("DELETE FROM photos WHERE created_at < now() - %s * interval '1 second' "
+                            "AND NOT EXISTS (SELECT 1 FROM places WHERE places.photo_hash = photos.hash)",
+                            (self.orphan_ttl,))
+                removed = cur.rowcount
+            self._count('removed', removed)
+        except psycopg2.Error:
+            pass
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+
+photo_ingest = PhotoIngest(workers=PHOTO_INGEST_WORKERS,
+                           thumbnail_width=PHOTO_THUMBNAIL_WIDTH,
+                           orphan_ttl=PHOTO_ORPHAN_TTL,
+                           cleanup_interval=PHOTO_CLEANUP_INTERVAL)
+
+
 class Place:
     def __init__(self, user_id, user_name, title):
         self.user_id = user_id
         self.user_name = user_name
         self.title = title
-        self.photo = None
+        self.photo_file_id = None
+        self.photo_thumbnail_file_id = None
         self.latitude = None
         self.longitude = None
 
 
+class ConversationStateBackend(HandlerBackend, metaclass=abc.ABCMeta):
+    def __init__(self, ttl):
+        super().__init__()
+        self.ttl = ttl
+
+    def register_handler(self, handler_group_id, handler):
+        self.save_state(handler_group_id, encode_step(handler), time.time() + self.ttl)
+
+    def clear_handlers(self, handler_group_id):
+        if self.has_state(handler_group_id):
+            self.pop_state(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        if not self.has_state(handler_group_id):
+            return []
+        state = self.pop_state(handler_group_id)
+        if state is None:
+            return []
+        return [decode_step(state)]
+
+    @abc.abstractmethod
+    def save_state(self, chat_id, state, expires_at):
+        pass
+
+    @abc.abstractmethod
+    def has_state(self, chat_id):
+        pass
+
+    @abc.abstractmethod
+    def pop_state(self, chat_id):
+        pass
+
+
+class PostgresStateBackend(ConversationStateBackend):
+    def __init__(self, ttl, cleanup_every=1000):
+        super().__init__(ttl)
+        self.cleanup_every = cleanup_every
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def save_state(self, chat_id, state, expires_at):
+        with self._lock:
+            self._saved += 1
+            cleanup = self._saved % self.cleanup_every == 0
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("INSERT INTO conversation_state (chat_id, state, expires_at) VALUES (%s, %s, to_timestamp(%s) AT TIME ZONE 'UTC') "
+                        "ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at",
+                        (chat_id, state, expires_at))
+            if cleanup:
+                cur.execute("DELETE FROM conversation_state WHERE expires_at < now() AT TIME ZONE 'UTC'")
+
+    def has_state(self, chat_id):
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("SELECT 1 FROM conversation_state WHERE chat_id = %s", (chat_id,))
+            return cur.fetchone() is not None
+
+    def pop_state(self, chat_id):
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("DELETE FROM conversation_state WHERE chat_id = %s RETURNING state, expires_at > now() AT TIME ZONE 'UTC'",
+                        (chat_id,))
+            data = cur.fetchone()
+        if data is None or not data[1]:
+            return None
+        return data[0]
+
+
+class SQLiteStateBackend(ConversationStateBackend):
+    def __init__(self, ttl, filename):
+        super().__init__(ttl)
+        self.filename = filename
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS conversation_state (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)")
+            con.execute("DELETE FROM conversation_state WHERE expires_at < ?", (time.time(),))
+
+    def save_state(self, chat_id, state, expires_at):
+        with self._connection() as con:
+            con.execute("INSERT OR REPLACE INTO conversation_state (chat_id, state, expires_at) VALUES (?, ?, ?)",
+                        (chat_id, state, expires_at))
+
+    def has_state(self, chat_id):
+        with self._connection() as con:
+            return con.execute("SELECT 1 FROM conversation_state WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+    def pop_state(self, chat_id):
+        with self._connection() as con:
+            con.execute("BEGIN IMMEDIATE")
+            data = con.execute("SELECT state, expires_at FROM conversation_state WHERE chat_id = ?",
+                               (chat_id,)).fetchone()
+            if data is not None:
+                con.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+        if data is None or data[1] < time.time():
+            return None
+        return data[0]
+
+    def _connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return SQLiteTransaction(con)
+
+
+class SQLiteTransaction:
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self.con
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.con.in_transaction:
+            self.con.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def encode_step(handler):
+    return json.dumps({'step': handler.callback.__name__,
+                       'args': handler.args,
+                       'kwargs': handler.kwargs}, default=encode_state_value)
+
+
+def decode_step(state):
+    data = json.loads(state, object_hook=decode_state_value)
+    return Handler(CONVERSATION_STEPS[data['step']], *data['args'], **data['kwargs'])
+
+
+def encode_state_value(value):
+    if isinstance(value, Place):
+        return {'__place__': value.__dict__}
+    raise TypeError(f'{type(value).__name__} is not allowed in conversation state')
+
+
+def decode_state_value(value):
+    if '__place__' in value:
+        place = Place(None, None, None)
+        place.__dict__.update(value['__place__'])
+        return place
+    return value
+
+
+def create_conversation_state_backend():
+    if CONVERSATION_STATE_BACKEND == 'postgres':
+        return PostgresStateBackend(ttl=CONVERSATION_STATE_TTL)
+    return SQLiteStateBackend(ttl=CONVERSATION_STATE_TTL, filename=CONVERSATION_STATE_FILE)
+
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_list_answer(answer, ids):
+    number, text = answer.split(' ', maxsplit=1)
+    index = int(number) - 1
+    if not 0 <= index < len(ids):
+        raise ValueError()
+    return ids[index], text
+
+
+def send_place_photo(chat_id, place_id, photo_file_id, has_photo_blob, caption=None, thumbnail=False):
+    if photo_file_id:
+        bot.send_photo(chat_id, photo=photo_file_id, caption=caption)
+        return
+    if not has_photo_blob:
+        return
+    def select(con):
+        cur = con.cursor()
+        DB.select_photo(cur, place_id=place_id, thumbnail=thumbnail)
+        return cur.fetchone()[0]
+    photo = DB.read(select, user_id=chat_id)
+    sent = bot.send_photo(chat_id, photo=bytes(photo), caption=caption)
+    if thumbnail:
+        return
+    try:
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.update(cur, table_name='places', field_name='photo_file_id', new_value=sent.photo[-1].file_id,
+                      cond_field_list=['id'], cond_value_list=[place_id])
+    except psycopg2.Error:
+        pass
+
+
+def send_places(chat_id, places, distances=None, header=None):
+    captions = []
+    for i, (_, title, _, _, _, _) in enumerate(places):
+        caption = f'{i + 1}. {title}'
+        if distances is not None:
+            caption += f' - {distances[i]:.2f} м'
+        captions.append(caption)
+    for text in split_message([header] + captions if header else captions):
+        bot.send_message(chat_id, text)
+
+    media = []
+    for caption, (place_id, _, photo_file_id, has_photo_blob, _, _) in zip(captions, places):
+        if photo_file_id:
+            media.append(InputMediaPhoto(photo_file_id, caption=caption))
+        elif has_photo_blob:
+            send_place_photo(chat_id, place_id, photo_file_id,
+                             has_photo_blob, caption=caption, thumbnail=True)
+    for start in range(0, len(media), MEDIA_GROUP_SIZE):
+        group = media[start:start + MEDIA_GROUP_SIZE]
+        if len(group) == 1:
+            bot.send_photo(chat_id, photo=group[0].media, caption=group[0].caption)
+        else:
+            bot.send_media_group(chat_id, group)
+
+    for i, (caption, place) in enumerate(zip(captions, places)):
+        latitude, longitude = place[4], place[5]
+        if latitude and longitude:
+            if distances is not None:
+                address = f'Расстояние: {distances[i]:.2f} метров'
+            else:
+                address = f'{latitude:.6f}, {longitude:.6f}'
+            bot.send_venue(chat_id, latitude=latitude, longitude=longitude,
+                           title=caption, address=address)
+
+
+def split_message(lines, max_length=MESSAGE_MAX_LENGTH):
+    chunks = []
+    current = ''
+    for line in lines:
+        line = line[:max_length]
+        if current and len(current) + len(line) + 1 > max_length:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def create_temporary_reply_keyboard(*fields):
     table = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     button_list = [KeyboardButton(field) for field in fields]
@@ -190,9 +1680,9 @@ def add_name_step(message: Message):
 def add_photo_step(message: Message, place: Place):
     try:
         if message.photo:
-            photo_info = bot.get_file(
-                message.photo[len(message.photo)-1].file_id)
-            place.photo = bot.download_file(photo_info.file_path)
+            place.photo_file_id = message.photo[len(message.photo)-1].file_id
+            if PHOTO_KEEP_BLOB:
+                place.photo_thumbnail_file_id = photo_ingest.get_thumbnail(message.photo).file_id
         keyboard = create_temporary_reply_keyboard('Пропустить')
         msg = bot.send_message(
             message.from_user.id, 'Отправьте геопозицию', reply_markup=keyboard)
@@ -219,50 +1709,41 @@ def add_geoposition_step(message: Message, place: Place):
 
 
 def add_save_in_database_step(message: Message, place: Place):
-    con = None
-    cur = None
-
     try:
         if message.text != 'Да':
             bot.send_message(message.from_user.id, 'Место не было сохранено',
                              reply_markup=ReplyKeyboardRemove())
             return
 
-        con = DB.connect()
-        cur = con.cursor()
-        DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
-                  place.user_id, place.user_name], conflict_field_list=['user_id'])
-        fields_list = ['user_id', 'title',
-                       'photo', 'latitude', 'longitude']
-        values_list = [place.user_id, place.title,
-                       place.photo, place.latitude, place.longitude]
-        DB.insert(cur, table_name='places',
-                  fields_list=fields_list, values_list=values_list)
-        con.commit()
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
+                      place.user_id, place.user_name], conflict_field_list=['user_id'])
+            fields_list = ['user_id', 'title',
+                           'photo_file_id', 'latitude', 'longitude']
+            values_list = [place.user_id, place.title,
+                           place.photo_file_id, place.latitude, place.longitude]
+            DB.insert(cur, table_name='places',
+                      fields_list=fields_list, values_list=values_list, returning_field='id')
+            place_id = cur.fetchone()[0]
+        if PHOTO_KEEP_BLOB and place.photo_file_id:
+            photo_ingest.attach(place_id, place.photo_file_id, place.photo_thumbnail_file_id)
+        user_settings_cache.invalidate(place.user_id)
+        DB.mark_written(place.user_id)
+        reload_live_session(place.user_id)
         bot.send_message(message.from_user.id, 'Место сохранено',
                          reply_markup=ReplyKeyboardRemove())
     except psycopg2.Error:
-        if con:
-            con.rollback()
         bot.reply_to(message, 'Ошибка при сохранении ',
                      reply_markup=ReplyKeyboardRemove())
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
 
 
 @bot.message_handler(commands=['list'])
 def list_command(message: Message):
-    con = None
-    cur = None
-
     try:
-        con = DB.connect()
-        cur = con.cursor()
-
         list_size = DEFAULT_LIST_OF_PLACES_SIZE
         command = message.text.split(' ', maxsplit=1)
         if len(command) == 2:
@@ -271,42 +1752,102 @@ def list_command(message: Message):
             else:
                 raise ValueError()
         else:
-            DB.select(cur, table_name='users', fields_list=['list_size'], cond_field_list=[
-                      'user_id'], cond_value_list=[message.from_user.id])
-            data = cur.fetchone()
-            if data:
-                list_size = data[0]
+            settings = get_user_settings(message.from_user.id)
+            if settings:
+                list_size = settings.list_size
             else:
                 bot.send_message(message.from_user.id,
                                  'У вас еще нет сохраненных мест')
                 return
 
-        fields_list = ['title', 'photo', 'latitude', 'longitude']
-        DB.select(cur, table_name='places', fields_list=fields_list,
-                  cond_field_list=['user_id'], cond_value_list=[message.from_user.id],
-                  order_field='id', reverse_order=True, limit=list_size)
-        place_list = cur.fetchall()
-        if len(place_list) == 0:
+        page = get_list_page(message.from_user.id, min(list_size, LIST_MAX_PAGE_SIZE))
+        if page is None:
             bot.send_message(message.from_user.id,
                              'У вас еще нет сохраненных мест')
             return
-        for place in place_list:
-            title, photo, latitude, longitude = place
-            bot.send_message(message.from_user.id, title)
-            if photo:
-                bot.send_photo(message.from_user.id, photo=photo)
-            if latitude and longitude:
-                bot.send_location(
-                    message.from_user.id, latitude=latitude, longitude=longitude)
+        text, markup = page
+        bot.send_message(message.from_user.id, text, reply_markup=markup)
     except ValueError:
         bot.reply_to(message, 'Длина списка должна быть целым числом больше 0')
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при получении списка сохраненных мест')
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE)
-    finally:
-        if con:
-            con.close()
+
+
+def build_keyset_page(places, page_size, after, before, prefix, key):
+    if not places:
+        return None
+    has_more = len(places) > page_size
+    if before:
+        places = places[-page_size:]
+    else:
+        places = places[:page_size]
+    has_previous = (after is not None) or (before is not None and has_more)
+    has_next = (before is not None) or has_more
+
+    markup = InlineKeyboardMarkup()
+    for place in places:
+        markup.row(InlineKeyboardButton(place[1], callback_data=f'place:{place[0]}'))
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton(
+            '« Назад', callback_data=f'{prefix}:prev:{key(places[0])}'))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            'Далее »', callback_data=f'{prefix}:next:{key(places[-1])}'))
+    if navigation:
+        markup.row(*navigation)
+    return markup
+
+
+def edit_page(call, page):
+    bot.answer_callback_query(call.id)
+    if page is None:
+        return
+    text, markup = page
+    bot.edit_message_text(text, chat_id=call.message.chat.id,
+                          message_id=call.message.message_id, reply_markup=markup)
+
+
+def get_list_page(user_id, page_size, after=None, before=None):
+    places = DB.read(lambda con: DB.select_page(con.cursor(), table_name='places', fields_list=['id', 'title'],
+                                                key_field='id', cond_field_list=['user_id'],
+                                                cond_value_list=[user_id], after=after, before=before,
+                                                limit=page_size + 1),
+                     user_id=user_id)
+    markup = build_keyset_page(places, page_size, after, before, 'list',
+                               key=lambda place: f'{page_size}:{place[0]}')
+    if markup is None:
+        return None
+    return 'Сохраненные места', markup
+
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('list:'))
+def list_callback(call: CallbackQuery):
+    try:
+        _, action, page_size, place_id = call.data.split(':')
+        page_size = min(int(page_size), LIST_MAX_PAGE_SIZE)
+        if action == 'next':
+            page = get_list_page(call.from_user.id, page_size, after=int(place_id))
+        else:
+            page = get_list_page(call.from_user.id, page_size, before=int(place_id))
+        edit_page(call, page)
+    except psycopg2.Error:
+        bot.answer_callback_query(call.id, 'Ошибка при получении списка сохраненных мест')
+    except Exception:
+        bot.answer_callback_query(call.id, ERROR_MESSAGE)
+
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('place:'))
+def place_callback(call: CallbackQuery):
+    try:
+        bot.answer_callback_query(call.id)
+        send_place_details(call.from_user.id, int(call.data.split(':')[1]))
+    except psycopg2.Error:
+        bot.send_message(call.from_user.id, 'Ошибка при получении информации о месте')
+    except Exception:
+        bot.send_message(call.from_user.id, ERROR_MESSAGE)
 
 
 @bot.message_handler(commands=['reset_all'])
@@ -322,90 +1863,99 @@ def reset_all(message: Message):
 
 
 def reset_delete_from_database_step(message: Message):
-    con = None
-    cur = None
-
     try:
         if message.text != 'Удалить':
             bot.send_message(
                 message.from_user.id, 'Удаление отменено', reply_markup=ReplyKeyboardRemove())
             return
-        
-        con = DB.connect()
-        cur = con.cursor()
-        DB.delete(cur, table_name='users', cond_field_list=[
-                  'user_id'], cond_value_list=[message.from_user.id])
-        con.commit()
+
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.delete(cur, table_name='users', cond_field_list=[
+                      'user_id'], cond_value_list=[message.from_user.id])
+        user_settings_cache.invalidate(message.from_user.id)
+        DB.mark_written(message.from_user.id)
+        friend_graph.clear()
+        live_sessions.invalidate(message.from_user.id)
         bot.send_message(
             message.from_user.id, 'Все данные удалены', reply_markup=ReplyKeyboardRemove())
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при удалении',
                      reply_markup=ReplyKeyboardRemove())
-        if con:
-            con.rollback()
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
 
 
 @bot.message_handler(content_types=['location'])
 def get_places_within_radius(message: Message):
-    con = None
-    cur = None
-
     try:
-        con = DB.connect()
-        cur = con.cursor()
-        radius = DEFAULT_RADIUS
-        DB.select(cur, table_name='users', fields_list=[
-                  'radius', 'friend_place_visible'], cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
-        data = cur.fetchone()
-        if data:
-            radius = data[0]
-        else:
+        if get_live_period(message):
+            track_live_location(message)
+            return
+        settings = get_user_settings(message.from_user.id)
+        if not settings:
             bot.send_message(message.from_user.id,
                              'У вас еще нет сохраненных мест')
             return
-        visible = data[1]
-        fields_list = ['title', 'photo', 'latitude', 'longitude']
-        if visible:
-            cur.execute("SELECT title, photo, latitude, longitude FROM places WHERE user_id IN (SELECT user_id FROM friends WHERE friend_id = %s) OR user_id = %s",
-                        (message.from_user.id, message.from_user.id))
+        owner_ids = get_visible_owner_ids(message.from_user.id, settings)
+        fields_list = ['id', 'title', 'photo_file_id', HAS_PHOTO_BLOB, 'latitude', 'longitude']
+        if settings.nearest_count:
+            k = settings.nearest_count
+            max_distance = settings.nearest_max_radius
         else:
-            DB.select(cur, table_name='places', fields_list=fields_list,
-                      cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
-        user_places_list = cur.fetchall()
-        if len(user_places_list) == 0:
+            k = None
+            max_distance = settings.radius
+
+        def select(con):
+            cur = con.cursor()
+            if k:
+                DB.select_nearest(cur, fields_list=fields_list, owner_ids=owner_ids,
+                                  latitude=message.location.latitude, longitude=message.location.longitude,
+                                  limit=k, max_radius=max_distance)
+            else:
+                box = get_bounding_box(
+                    message.location.latitude, message.location.longitude, max_distance)
+                DB.select_within_box(cur, fields_list=fields_list,
+                                     owner_ids=owner_ids, box=box)
+            return cur.fetchall()
+        user_places_list = DB.read(select, user_id=message.from_user.id)
+        distances = get_distances_meters([place[4] for place in user_places_list],
+                                         [place[5] for place in user_places_list],
+                                         message.location.latitude, message.location.longitude)
+        nearest = get_nearest_indexes(distances, k=k, max_distance=max_distance)
+        if len(nearest) == 0:
             bot.send_message(message.from_user.id,
                              'Сохраненные места не найдены')
             return
-        for place in user_places_list:
-            title, photo, latitude, longitude = place
-            if latitude and longitude:
-                distance_meters = get_distance_meters(
-                    latitude, longitude, message.location.latitude, message.location.longitude)
-                if distance_meters <= radius:
-                    bot.send_message(message.from_user.id, title)
-                    if photo:
-                        bot.send_photo(message.from_user.id, photo=photo)
-                    bot.send_location(
-                        message.from_user.id, latitude=latitude, longitude=longitude)
-                    bot.send_message(message.from_user.id,
-                                     f'Расстояние: {distance_meters:.2f} метров')
+        send_clustered_places(message.from_user.id, [user_places_list[i] for i in nearest],
+                              distances=distances[nearest].tolist())
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при получении списка сохраненных мест')
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE)
-    finally:
-        if con:
-            con.close()
+
+
+def get_bounding_box(latitude, longitude, radius):
+    delta_latitude = math.degrees(radius / EARTH_RADIUS_M)
+    min_latitude = latitude - delta_latitude
+    max_latitude = latitude + delta_latitude
+    if min_latitude <= -90 or max_latitude >= 90:
+        return max(min_latitude, -90.0), min(max_latitude, 90.0), None, None
+
+    delta_longitude = math.degrees(
+        math.asin(min(1.0, math.sin(radius / EARTH_RADIUS_M) / math.cos(math.radians(latitude)))))
+    min_longitude = longitude - delta_longitude
+    max_longitude = longitude + delta_longitude
+    if min_longitude < -180:
+        min_longitude += 360
+    if max_longitude > 180:
+        max_longitude -= 360
+    return min_latitude, max_latitude, min_longitude, max_longitude
 
 
 def get_distance_meters(lat1d, long1d, lat2d, long2d):
-    earth_radius_m = 6371009
+    earth_radius_m = EARTH_RADIUS_M
 
     lat1 = math.radians(lat1d)
     long1 = math.radians(long1d)
@@ -427,11 +1977,241 @@ def get_distance_meters(lat1d, long1d, lat2d, long2d):
     return ad * earth_radius_m
 
 
+class PlaceVectors:
+    def __init__(self, latitudes, longitudes):
+        latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+        cos_latitudes = np.cos(latitudes)
+        self.vectors = np.column_stack((cos_latitudes * np.cos(longitudes),
+                                        cos_latitudes * np.sin(longitudes),
+                                        np.sin(latitudes)))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def distances_meters(self, latitude, longitude):
+        query = PlaceVectors([latitude], [longitude]).vectors[0]
+        x = self.vectors @ query
+        y = np.linalg.norm(np.cross(self.vectors, query), axis=1)
+        return np.arctan2(y, x) * EARTH_RADIUS_M
+
+
+def get_distances_meters(latitudes, longitudes, latitude, longitude):
+    latitudes = np.array(latitudes, dtype=np.float64)
+    longitudes = np.array(longitudes, dtype=np.float64)
+    distances = np.full(len(latitudes), np.inf)
+    known = ~(np.isnan(latitudes) | np.isnan(longitudes)) & (latitudes != 0) & (longitudes != 0)
+    distances[known] = PlaceVectors(latitudes[known], longitudes[known]).distances_meters(
+        latitude, longitude)
+    return distances
+
+
+def get_nearest_indexes(distances, k=None, max_distance=None):
+    distances = np.asarray(distances)
+    candidates = np.flatnonzero(np.isfinite(distances))
+    if max_distance is not None:
+        candidates = candidates[distances[candidates] <= max_distance]
+    if k is not None and k < len(candidates):
+        candidates = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+    return candidates[np.argsort(distances[candidates], kind='stable')]
+
+
+class LiveSession:
+    def __init__(self):
+        self.cell = None
+        self.query_radius = None
+        self.places = []
+        self.vectors = None
+        self.inside = set()
+
+    def load(self, user_id, settings, cell, center, margin):
+        owner_ids = get_visible_owner_ids(user_id, settings)
+        box = get_bounding_box(center[0], center[1], settings.radius + margin)
+        def select(con):
+            cur = con.cursor()
+            DB.select_within_box(cur, fields_list=['id', 'title', 'photo_file_id', HAS_PHOTO_BLOB, 'latitude', 'longitude'],
+                                 owner_ids=owner_ids, box=box)
+            return cur.fetchall()
+        places = DB.read(select, user_id=user_id)
+        self.places = [place for place in places if place[4] and place[5]]
+        self.vectors = PlaceVectors([place[4] for place in self.places],
+                                    [place[5] for place in self.places]) if self.places else None
+        self.cell = cell
+        self.query_radius = settings.radius
+
+    def evaluate(self, latitude, longitude, radius):
+        if self.vectors is None:
+            self.inside = set()
+            return [], np.empty(0)
+        distances = self.vectors.distances_meters(latitude, longitude)
+        entered = [i for i in get_nearest_indexes(distances, max_distance=radius)
+                   if self.places[i][0] not in self.inside]
+        self.inside = {place[0] for place, distance in zip(self.places, distances)
+                       if distance <= radius or (place[0] in self.inside and distance <= radius * GEOFENCE_EXIT_FACTOR)}
+        return entered, distances[entered]
+
+
+live_sessions = TTLCache(max_size=GEOFENCE_SESSION_LIMIT, ttl=GEOFENCE_IDLE_TTL)
+
+
+def get_live_period(message):
+    if not isinstance(message.json, dict):
+        return None
+    return (message.json.get('location') or {}).get('live_period')
+
+
+def get_grid_cell_degrees(row, cell_size):
+    cell_degrees = math.degrees(cell_size / EARTH_RADIUS_M)
+    row_latitude = (row + 0.5) * cell_degrees
+    return cell_degrees, cell_degrees / max(math.cos(math.radians(row_latitude)), 0.01)
+
+
+def get_grid_cell(latitude, longitude, cell_size=GEOFENCE_CELL_SIZE):
+    row = math.floor(latitude / math.degrees(cell_size / EARTH_RADIUS_M))
+    cell_degrees, column_degrees = get_grid_cell_degrees(row, cell_size)
+    column = math.floor(longitude / column_degrees)
+    return (row, column), ((row + 0.5) * cell_degrees, (column + 0.5) * column_degrees)
+
+
+def get_grid_cell_margin(cell, center, cell_size=GEOFENCE_CELL_SIZE):
+    row, column = cell
+    cell_degrees, column_degrees = get_grid_cell_degrees(row, cell_size)
+    return max(get_distance_meters(center[0], center[1], corner_latitude, corner_longitude)
+               for corner_latitude in (row * cell_degrees, (row + 1) * cell_degrees)
+               for corner_longitude in (column * column_degrees, (column + 1) * column_degrees))
+
+
+def track_live_location(message: Message):
+    user_id = message.from_user.id
+    if not get_live_period(message):
+        live_sessions.invalidate(user_id)
+        return
+    settings = get_user_settings(user_id)
+    if not settings:
+        return
+    session = live_sessions.get(user_id) or LiveSession()
+    latitude, longitude = message.location.latitude, message.location.longitude
+    cell, center = get_grid_cell(latitude, longitude)
+    if cell != session.cell or settings.radius > session.query_radius:
+        session.load(user_id, settings, cell, center, get_grid_cell_margin(cell, center))
+    entered, distances = session.evaluate(latitude, longitude, settings.radius)
+    live_sessions.set(user_id, session)
+    if entered:
+        send_places(user_id, [session.places[i] for i in entered], distances=distances,
+                    header='Вы рядом с сохраненными местами:')
+
+
+def reload_live_session(user_id):
+    session = live_sessions.get(user_id)
+    if session is not None:
+        session.cell = None
+
+
+@bot.edited_message_handler(content_types=['location'])
+def live_location_update(message: Message):
+    try:
+        track_live_location(message)
+    except Exception:
+        mark_handler_failed()
+
+
+cluster_results = TTLCache(max_size=CLUSTER_CACHE_SIZE, ttl=CLUSTER_CACHE_TTL)
+cluster_tokens = itertools.count(1)
+
+
+def cluster_places(places, cell_size):
+    clusters = {}
+    for i, place in enumerate(places):
+        cell, _ = get_grid_cell(place[4], place[5], cell_size)
+        clusters.setdefault(cell, []).append(i)
+    return list(clusters.values())
+
+
+def send_clustered_places(chat_id, places, distances):
+    if len(places) <= CLUSTER_THRESHOLD:
+        send_places(chat_id, places, distances=distances)
+        return
+    latitudes = [place[4] for place in places]
+    longitudes = [place[5] for place in places]
+    extent = get_distance_meters(min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+    if extent < CLUSTER_MIN_CELL_SIZE:
+        order = sorted(range(len(places)), key=lambda i: distances[i])
+        places = [places[i] for i in order]
+        distances = [distances[i] for i in order]
+        token = str(next(cluster_tokens))
+        cluster_results.set(token, (chat_id, places, distances))
+        text, markup = get_cluster_page(token, places, distances, 0)
+        bot.send_message(chat_id, text, reply_markup=markup)
+        return
+
+    cell_size = max(extent / CLUSTER_GRID_SIZE, CLUSTER_MIN_CELL_SIZE)
+    clusters = cluster_places(places, cell_size)
+    while len(clusters) > CLUSTER_MAX_COUNT:
+        cell_size *= 2
+        clusters = cluster_places(places, cell_size)
+    clusters.sort(key=lambda indexes: min(distances[i] for i in indexes))
+
+    bot.send_message(chat_id, f'Найдено мест: {len(places)}. Места сгруппированы по районам, '
+                              'нажмите на кнопку под группой, чтобы увидеть места')
+    for indexes in clusters:
+        nearest = min(indexes, key=lambda i: distances[i])
+        token = str(next(cluster_tokens))
+        cluster_results.set(token, (chat_id, [places[i] for i in indexes], [distances[i] for i in indexes]))
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton(f'Показать ({len(indexes)})', callback_data=f'cluster:{token}'))
+        bot.send_venue(chat_id,
+                       latitude=sum(latitudes[i] for i in indexes) / len(indexes),
+                       longitude=sum(longitudes[i] for i in indexes) / len(indexes),
+                       title=f'Мест в группе: {len(indexes)}' if len(indexes) > 1 else places[nearest][1],
+                       address=f'Ближайшее: {places[nearest][1]} - {distances[nearest]:.2f} м',
+                       reply_markup=markup)
+
+
+def get_cluster_page(token, places, distances, offset):
+    markup = InlineKeyboardMarkup()
+    end = min(offset + CLUSTER_PAGE_SIZE, len(places))
+    for i in range(offset, end):
+        markup.row(InlineKeyboardButton(f'{places[i][1]} - {distances[i]:.2f} м',
+                                        callback_data=f'place:{places[i][0]}'))
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(
+            '« Назад', callback_data=f'cluster:{token}:{max(offset - CLUSTER_PAGE_SIZE, 0)}'))
+    if end < len(places):
+        navigation.append(InlineKeyboardButton(
+            'Далее »', callback_data=f'cluster:{token}:{end}'))
+    if navigation:
+        markup.row(*navigation)
+    return f'Найдено мест: {len(places)}. Места расположены слишком близко друг к другу, ' \
+           'чтобы сгруппировать их', markup
+
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('cluster:'))
+def cluster_callback(call: CallbackQuery):
+    try:
+        _, token, *offset = call.data.split(':')
+        cluster = cluster_results.get(token)
+        if cluster is None or cluster[0] != call.from_user.id:
+            bot.answer_callback_query(call.id, 'Результаты устарели, отправьте геопозицию еще раз')
+            return
+        bot.answer_callback_query(call.id)
+        _, places, distances = cluster
+        if offset:
+            text, markup = get_cluster_page(token, places, distances, int(offset[0]))
+            bot.edit_message_text(text, chat_id=call.message.chat.id,
+                                  message_id=call.message.message_id, reply_markup=markup)
+            return
+        send_clustered_places(call.from_user.id, places, distances)
+    except Exception:
+        bot.send_message(call.from_user.id, ERROR_MESSAGE)
+
+
 @bot.message_handler(commands=['settings'])
 def change_settings(message: Message):
     try:
         settings = [
-            'Размер списка (list)', 'Радиус поиска ближайших мест', 'Просмотр мест друзей']
+            'Размер списка (list)', 'Радиус поиска ближайших мест', 'Количество ближайших мест',
+            'Макс. расстояние до ближайших мест', 'Просмотр мест друзей']
         keyboard = create_temporary_reply_keyboard(*settings)
         msg = bot.send_message(
             message.from_user.id, 'Выберите параметр для настройки', reply_markup=keyboard)
@@ -463,14 +2243,7 @@ def change_settings_new_value_input(message: Message, settings):
 
 
 def change_settings_update(message: Message, setting):
-    con = None
-    cur = None
-
     try:
-        con = DB.connect()
-        cur = con.cursor()
-        DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
-                  message.from_user.id, message.from_user.first_name], conflict_field_list=['user_id'])
         value = message.text
         field_name = None
         if setting == 'Размер списка (list)':
@@ -484,6 +2257,18 @@ def change_settings_update(message: Message, setting):
             field_name = 'radius'
             if not value > 0:
                 raise RuntimeError('Радиус поиска должен быть больше 0')
+        elif setting == 'Количество ближайших мест':
+            value = int(value)
+            field_name = 'nearest_count'
+            if not 0 <= value <= NEAREST_MAX_COUNT:
+                raise RuntimeError(
+                    f'Количество мест должно быть целым числом от 0 до {NEAREST_MAX_COUNT} (0 - поиск по радиусу)')
+        elif setting == 'Макс. расстояние до ближайших мест':
+            value = float(value)
+            field_name = 'nearest_max_radius'
+            if not value >= 0:
+                raise RuntimeError('Расстояние должно быть не меньше 0 (0 - без ограничения)')
+            value = value or None
         elif setting == 'Просмотр мест друзей':
             if value == 'Включить':
                 value = True
@@ -493,9 +2278,14 @@ def change_settings_update(message: Message, setting):
                 raise ValueError('Недопустимое значение')
             field_name = 'friend_place_visible'
 
-        DB.update(cur, table_name='users', field_name=field_name, new_value=value,
-                  cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
-        con.commit()
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
+                      message.from_user.id, message.from_user.first_name], conflict_field_list=['user_id'])
+            DB.update(cur, table_name='users', field_name=field_name, new_value=value,
+                      cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
+        user_settings_cache.invalidate(message.from_user.id)
+        DB.mark_written(message.from_user.id)
         bot.send_message(message.from_user.id, 'Настройка изменена',
                          reply_markup=ReplyKeyboardRemove())
     except ValueError:
@@ -505,110 +2295,101 @@ def change_settings_update(message: Message, setting):
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при изменении параметров',
                      reply_markup=ReplyKeyboardRemove())
-        if con:
-            con.rollback()
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
 
 
 @bot.message_handler(commands=['search'])
 def search(message: Message):
-    con = None
-    cur = None
+    try:
+        msg = bot.send_message(message.from_user.id, 'Введите название места',
+                               reply_markup=ReplyKeyboardRemove())
+        bot.register_next_step_handler(msg, search_query_step)
+    except Exception:
+        bot.reply_to(message, ERROR_MESSAGE,
+                     reply_markup=ReplyKeyboardRemove())
+
 
+def search_query_step(message: Message):
     try:
-        con = DB.connect()
-        cur = con.cursor()
-        DB.select(cur, table_name='users', fields_list=['friend_place_visible'],
-                  cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
-        visible = cur.fetchone()
-        if visible is None:
-            bot.send_message(message.from_user.id,
-                             'Сохраненных мест не найдено')
-            return
-        visible = visible[0]
-        if visible == True:
-            cur.execute("SELECT title, id FROM places WHERE user_id IN (SELECT user_id FROM friends WHERE friend_id = %s) OR user_id = %s",
-                        (message.from_user.id, message.from_user.id))
-        else:
-            DB.select(cur, table_name='places', fields_list=['title', 'id'],
-                      cond_field_list=['user_id'], cond_value_list=[message.from_user.id])
-        places = cur.fetchall()
-        if not places or len(places) == 0:
+        if not message.text:
+            raise ValueError()
+        text = message.text.strip()[:SEARCH_QUERY_MAX_LENGTH]
+        page = get_search_page(message.from_user.id, text)
+        if page is None:
             bot.send_message(message.from_user.id,
                              'Сохраненных мест не найдено')
             return
-        title_list = [str(i + 1) + ' ' + places[i][0]
-                      for i in range(len(places))]
-        keyboard = create_temporary_reply_keyboard(*title_list)
-        msg = bot.send_message(message.from_user.id,
-                               'Выберите место', reply_markup=keyboard)
-        bot.register_next_step_handler(
-            msg, search_in_database, places_list=places, title_list=title_list)
+        text, markup = page
+        bot.send_message(message.from_user.id, text, reply_markup=markup)
+    except ValueError:
+        bot.reply_to(message, 'Недопустимое значение')
     except psycopg2.Error:
-        bot.reply_to(message, 'Ошибка при получении списка сохраненных мест',
-                     reply_markup=ReplyKeyboardRemove())
+        bot.reply_to(message, 'Ошибка при получении списка сохраненных мест')
     except Exception:
-        bot.reply_to(message, ERROR_MESSAGE,
-                     reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
+        bot.reply_to(message, ERROR_MESSAGE)
 
 
-def search_in_database(message: Message, places_list, title_list):
-    con = None
-    cur = None
+def get_search_page(user_id, text, after=None, before=None):
+    settings = get_user_settings(user_id)
+    if settings is None:
+        return None
+    owner_ids = get_visible_owner_ids(user_id, settings)
+    places = DB.read(lambda con: DB.search_titles(con.cursor(), owner_ids=owner_ids, text=text,
+                                                  after=after, before=before, limit=SEARCH_PAGE_SIZE + 1),
+                     user_id=user_id)
+    markup = build_keyset_page(places, SEARCH_PAGE_SIZE, after, before, 'search',
+                               key=lambda place: f'{place[2]!r}:{place[0]}')
+    if markup is None:
+        return None
+    return SEARCH_RESULTS_TITLE + text, markup
 
-    try:
-        answer = message.text
-        if answer not in title_list:
-            raise ValueError()
-        place_list_id, _ = answer.split(' ', maxsplit=1)
-        title, place_id = places_list[int(place_list_id) - 1]
 
-        con = DB.connect()
-        cur = con.cursor()
-        DB.select(cur, table_name='places', fields_list=[
-                  'photo', 'latitude', 'longitude'], cond_field_list=['id'], cond_value_list=[place_id])
-        found_place = cur.fetchone()
-        photo, latitude, longitude = found_place
-        bot.send_message(message.from_user.id, title,
-                         reply_markup=ReplyKeyboardRemove())
-        if photo:
-            bot.send_photo(message.from_user.id, photo=photo)
-        if latitude and longitude:
-            bot.send_location(message.from_user.id,
-                              latitude=latitude, longitude=longitude)
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('search:'))
+def search_callback(call: CallbackQuery):
+    try:
+        _, action, *args = call.data.split(':')
+        text = call.message.text[len(SEARCH_RESULTS_TITLE):]
+        key = (float(args[0]), int(args[1]))
+        if action == 'next':
+            page = get_search_page(call.from_user.id, text, after=key)
+        else:
+            page = get_search_page(call.from_user.id, text, before=key)
+        edit_page(call, page)
     except psycopg2.Error:
-        bot.reply_to(message, 'Ошибка при получении информации о месте',
-                     reply_markup=ReplyKeyboardRemove())
-    except ValueError:
-        bot.reply_to(message, 'Нет информации о месте',
-                     reply_markup=ReplyKeyboardRemove())
+        bot.answer_callback_query(call.id, 'Ошибка при получении списка сохраненных мест')
     except Exception:
-        bot.reply_to(message, ERROR_MESSAGE,
-                     reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
+        bot.answer_callback_query(call.id, ERROR_MESSAGE)
+
+
+def send_place_details(user_id, place_id):
+    owner_ids = get_visible_owner_ids(user_id, get_user_settings(user_id))
+    def select(con):
+        cur = con.cursor()
+        DB.select_visible_place(cur, fields_list=['id', 'title', 'photo_file_id', HAS_PHOTO_BLOB, 'latitude', 'longitude'],
+                                owner_ids=owner_ids, place_id=place_id)
+        return cur.fetchone()
+    found_place = DB.read(select, user_id=user_id)
+    if found_place is None:
+        bot.send_message(user_id, 'Нет информации о месте')
+        return
+    _, title, photo_file_id, has_photo_blob, latitude, longitude = found_place
+    bot.send_message(user_id, title)
+    send_place_photo(user_id, place_id, photo_file_id, has_photo_blob)
+    if latitude and longitude:
+        bot.send_location(user_id, latitude=latitude, longitude=longitude)
 
 
 @bot.message_handler(commands=['delete'])
 def delete(message: Message):
-    con = None
-    cur = None
-
     try:
-        con = DB.connect()
-        cur = con.cursor()
-        DB.select(cur, table_name='places', fields_list=['title', 'id'], cond_field_list=[
-                  'user_id'], cond_value_list=[message.from_user.id])
-        places = cur.fetchall()
+        def select(con):
+            cur = con.cursor()
+            DB.select(cur, table_name='places', fields_list=['title', 'id'], cond_field_list=[
+                      'user_id'], cond_value_list=[message.from_user.id])
+            return cur.fetchall()
+        places = DB.read(select, user_id=message.from_user.id)
         if len(places) == 0:
             bot.send_message(message.from_user.id,
                              'Сохраненных мест не найдено')
@@ -619,54 +2400,45 @@ def delete(message: Message):
         msg = bot.send_message(message.from_user.id,
                                'Выберите место', reply_markup=keyboard)
         bot.register_next_step_handler(
-            msg, delete_from_database, places_list=places, title_list=title_list)
+            msg, delete_from_database, place_ids=[place[1] for place in places])
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при получении списка сохраненных мест',
                      reply_markup=ReplyKeyboardRemove())
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
-
 
-def delete_from_database(message: Message, places_list, title_list):
-    con = None
-    cur = None
 
+def delete_from_database(message: Message, place_ids):
     try:
         answer = message.text
         if answer == 'Отмена':
             bot.send_message(message.from_user.id, 'Удаление отменено',
                              reply_markup=ReplyKeyboardRemove())
             return
-        if answer not in title_list:
+        if not answer:
             raise ValueError()
-        place_list_id, _ = answer.split(' ', maxsplit=1)
-        _, place_id = places_list[int(place_list_id) - 1]
+        place_id, title = parse_list_answer(answer, place_ids)
 
-        con = DB.connect()
-        cur = con.cursor()
-        DB.delete(cur, table_name='places', cond_field_list=[
-                  'id'], cond_value_list=[place_id])
-        con.commit()
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.delete(cur, table_name='places', cond_field_list=[
+                      'id', 'user_id', 'title'], cond_value_list=[place_id, message.from_user.id, title])
+            if cur.rowcount == 0:
+                raise ValueError()
+        reload_live_session(message.from_user.id)
+        DB.mark_written(message.from_user.id)
         bot.send_message(message.from_user.id, 'Место удалено',
                          reply_markup=ReplyKeyboardRemove())
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при удалении',
                      reply_markup=ReplyKeyboardRemove())
-        if con:
-            con.rollback()
     except ValueError:
         bot.reply_to(message, 'Нет информации о месте',
                      reply_markup=ReplyKeyboardRemove())
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
 
 
 @bot.message_handler(commands=['add_friend'])
@@ -682,18 +2454,12 @@ def add_friend(message: Message):
 
 
 def add_friend_to_database(message: Message):
-    con = None
-    cur = None
-
     try:
         if message.text == 'Отмена':
             bot.send_message(
                 message.from_user.id, 'Добавление отменено', reply_markup=ReplyKeyboardRemove())
             return
 
-        con = DB.connect()
-        cur = con.cursor()
-
         friend = message.contact
         if not friend:
             raise ValueError('Недопустимое значение')
@@ -701,20 +2467,22 @@ def add_friend_to_database(message: Message):
         if not friend.user_id:
             raise ValueError('Не удается определить id пользователя')
 
-        DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
-                  message.from_user.id, message.from_user.first_name], conflict_field_list=['user_id'])
-        DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
-                  friend.user_id, friend.first_name], conflict_field_list=['user_id'])
-        DB.insert(cur, table_name='friends', fields_list=[
-                  'user_id', 'friend_id'], values_list=[message.from_user.id, friend.user_id])
-        con.commit()
+        with DB.connection() as con:
+            cur = con.cursor()
+            DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
+                      message.from_user.id, message.from_user.first_name], conflict_field_list=['user_id'])
+            DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'], values_list=[
+                      friend.user_id, friend.first_name], conflict_field_list=['user_id'])
+            DB.insert(cur, table_name='friends', fields_list=[
+                      'user_id', 'friend_id'], values_list=[message.from_user.id, friend.user_id])
+        user_settings_cache.invalidate(message.from_user.id, friend.user_id)
+        friend_graph.invalidate(message.from_user.id, friend.user_id)
+        DB.mark_written(message.from_user.id, friend.user_id)
         bot.send_message(message.from_user.id, 'Друг добавлен',
                          reply_markup=ReplyKeyboardRemove())
     except ValueError as val_err:
         bot.reply_to(message, val_err, reply_markup=ReplyKeyboardRemove())
     except psycopg2.Error as err:
-        if con:
-            con.rollback()
         if str(err).find('duplicate key value violates unique constraint') != -1:
             bot.reply_to(message, 'Данный друг уже добавлен',
                          reply_markup=ReplyKeyboardRemove())
@@ -724,22 +2492,17 @@ def add_friend_to_database(message: Message):
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
 
 
 @bot.message_handler(commands=['delete_friend'])
 def delete_friend(message: Message):
-    con = None
-    cur = None
-
     try:
-        con = DB.connect()
-        cur = con.cursor()
-        cur.execute("SELECT user_name, friend_id FROM friends JOIN users ON (friends.friend_id = users.user_id) WHERE friends.user_id = %s",
-                    (message.from_user.id,))
-        friends = cur.fetchall()
+        def select(con):
+            cur = con.cursor()
+            cur.execute("SELECT user_name, friend_id FROM friends JOIN users ON (friends.friend_id = users.user_id) WHERE friends.user_id = %s",
+                        (message.from_user.id,))
+            return cur.fetchall()
+        friends = DB.read(select, user_id=message.from_user.id)
         if len(friends) == 0:
             bot.send_message(message.from_user.id,
                              'У вас нет сохраненных друзей')
@@ -750,70 +2513,401 @@ def delete_friend(message: Message):
         msg = bot.send_message(message.from_user.id,
                                'Выберите друга', reply_markup=keyboard)
         bot.register_next_step_handler(
-            msg, delete_friend_from_database, friends_list=friends, friends_name=friends_name)
+            msg, delete_friend_from_database, friend_ids=[friend[1] for friend in friends])
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при получении списка друзей',
                      reply_markup=ReplyKeyboardRemove())
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
-
 
-def delete_friend_from_database(message: Message, friends_list, friends_name):
-    con = None
-    cur = None
 
+def delete_friend_from_database(message: Message, friend_ids):
     try:
         answer = message.text
         if answer == 'Отмена':
             bot.send_message(message.from_user.id, 'Удаление отменено',
                              reply_markup=ReplyKeyboardRemove())
             return
-        if answer not in friends_name:
+        if not answer:
             raise ValueError()
-        friend_list_id, _ = answer.split(' ', maxsplit=1)
-        friend_id = friends_list[int(friend_list_id) - 1][1]
+        friend_id, friend_name = parse_list_answer(answer, friend_ids)
 
-        con = DB.connect()
-        cur = con.cursor()
-        DB.delete(cur, table_name='friends', cond_field_list=[
-                  'user_id', 'friend_id'], cond_value_list=[message.from_user.id, friend_id])
-        con.commit()
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("DELETE FROM friends USING users WHERE friends.friend_id = users.user_id AND friends.user_id = %s AND friends.friend_id = %s AND users.user_name = %s",
+                        (message.from_user.id, friend_id, friend_name))
+            if cur.rowcount == 0:
+                raise ValueError()
+        friend_graph.invalidate(message.from_user.id, friend_id)
+        DB.mark_written(message.from_user.id, friend_id)
         bot.send_message(message.from_user.id, 'Друг удален',
                          reply_markup=ReplyKeyboardRemove())
     except psycopg2.Error:
         bot.reply_to(message, 'Ошибка при удалении друга',
                      reply_markup=ReplyKeyboardRemove())
-        if con:
-            con.rollback()
     except ValueError:
         bot.reply_to(message, 'Нет информации о друге',
                      reply_markup=ReplyKeyboardRemove())
     except Exception:
         bot.reply_to(message, ERROR_MESSAGE,
                      reply_markup=ReplyKeyboardRemove())
-    finally:
-        if con:
-            con.close()
+
+
+EXPORT_FORMATS = {'csv': '.csv', 'geojson': '.geojson', 'gpx': '.gpx'}
+IMPORT_EXTENSIONS = {'.csv': 'csv', '.geojson': 'geojson', '.json': 'geojson', '.gpx': 'gpx'}
+TITLE_MAX_LENGTH = 256
+INVALID_FILE_MESSAGE = 'Недопустимый файл'
+
+
+@bot.message_handler(commands=['export'])
+def export(message: Message):
+    try:
+        command = message.text.split(' ', maxsplit=1)
+        if len(command) == 2:
+            export_places(message.from_user.id, command[1].strip().lower())
+            return
+        keyboard = create_temporary_reply_keyboard(*EXPORT_FORMATS, 'Отмена')
+        msg = bot.send_message(message.from_user.id, 'Выберите формат файла', reply_markup=keyboard)
+        bot.register_next_step_handler(msg, export_format_step)
+    except ValueError:
+        bot.reply_to(message, 'Неизвестный формат файла')
+    except psycopg2.Error:
+        bot.reply_to(message, 'Ошибка при выгрузке мест')
+    except Exception:
+        bot.reply_to(message, ERROR_MESSAGE)
+
+
+def export_format_step(message: Message):
+    try:
+        if message.text == 'Отмена':
+            bot.send_message(message.from_user.id, 'Выгрузка отменена',
+                             reply_markup=ReplyKeyboardRemove())
+            return
+        export_places(message.from_user.id, (message.text or '').lower())
+    except ValueError:
+        bot.reply_to(message, 'Неизвестный формат файла',
+                     reply_markup=ReplyKeyboardRemove())
+    except psycopg2.Error:
+        bot.reply_to(message, 'Ошибка при выгрузке мест',
+                     reply_markup=ReplyKeyboardRemove())
+    except Exception:
+        bot.reply_to(message, ERROR_MESSAGE,
+                     reply_markup=ReplyKeyboardRemove())
+
+
+def export_places(user_id, export_format):
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError()
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file:
+
+        def write(con):
+            file.seek(0)
+            file.truncate()
+            if export_format == 'csv':
+                DB.copy_places_to(con.cursor(), user_id, file)
+                return
+            cur = con.cursor(name='export_places')
+            cur.itersize = EXPORT_FETCH_SIZE
+            DB.select(cur, table_name='places', fields_list=['title', 'latitude', 'longitude'],
+                      cond_field_list=['user_id'], cond_value_list=[user_id], order_field='id')
+            if export_format == 'geojson':
+                write_geojson(file, cur)
+            else:
+                write_gpx(file, cur)
+            cur.close()
+        DB.read(write, user_id=user_id)
+        file.seek(0)
+        bot.send_document(user_id, ('places' + EXPORT_FORMATS[export_format], file),
+                          reply_markup=ReplyKeyboardRemove())
+
+
+def write_geojson(file, rows):
+    file.write(b'{"type": "FeatureCollection", "features": [')
+    separator = '\n'
+    for title, latitude, longitude in rows:
+        geometry = {'type': 'Point', 'coordinates': [longitude, latitude]} if latitude is not None and longitude is not None else None
+        file.write((separator + json.dumps({'type': 'Feature', 'geometry': geometry, 'properties': {'title': title}},
+                                           ensure_ascii=False)).encode('utf-8'))
+        separator = ',\n'
+    file.write(b'\n]}\n')
+
+
+def write_gpx(file, rows):
+    file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+               b'<gpx version="1.1" creator="geo_note_bot" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    for title, latitude, longitude in rows:
+        if latitude is None or longitude is None:
+            continue
+        file.write(f'<wpt lat="{latitude}" lon="{longitude}"><name>{xml.sax.saxutils.escape(title)}</name></wpt>\n'
+                   .encode('utf-8'))
+    file.write(b'</gpx>\n')
+
+
+@bot.message_handler(commands=['import'])
+def import_command(message: Message):
+    try:
+        keyboard = create_temporary_reply_keyboard('Отмена')
+        msg = bot.send_message(message.from_user.id,
+                               'Отправьте файл CSV (title, latitude, longitude), GeoJSON или GPX',
+                               reply_markup=keyboard)
+        bot.register_next_step_handler(msg, import_file_step)
+    except Exception:
+        bot.reply_to(message, ERROR_MESSAGE,
+                     reply_markup=ReplyKeyboardRemove())
+
+
+def import_file_step(message: Message):
+    try:
+        if message.text == 'Отмена':
+            bot.send_message(message.from_user.id, 'Загрузка отменена',
+                             reply_markup=ReplyKeyboardRemove())
+            return
+        if not message.document:
+            raise ValueError('Файл не найден')
+        extension = os.path.splitext(message.document.file_name or '')[1].lower()
+        if extension not in IMPORT_EXTENSIONS:
+            raise ValueError('Неизвестный формат файла')
+        data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+        imported, skipped = import_places(message.from_user.id, message.from_user.first_name,
+                                          IMPORT_EXTENSIONS[extension], io.BytesIO(data))
+        text = f'Загружено мест: {imported}'
+        if skipped:
+            text += f'\nПропущено строк с ошибками: {len(skipped)} (' + ', '.join(map(str, skipped[:10])) + \
+                    (', ...' if len(skipped) > 10 else '') + ')'
+        bot.send_message(message.from_user.id, text, reply_markup=ReplyKeyboardRemove())
+    except ValueError as err:
+        bot.reply_to(message, str(err) or 'Недопустимое значение',
+                     reply_markup=ReplyKeyboardRemove())
+    except psycopg2.Error:
+        bot.reply_to(message, 'Ошибка при сохранении ',
+                     reply_markup=ReplyKeyboardRemove())
+    except Exception:
+        bot.reply_to(message, ERROR_MESSAGE,
+                     reply_markup=ReplyKeyboardRemove())
+
+
+def import_places(user_id, user_name, import_format, file):
+    readers = {'csv': read_csv_places, 'geojson': read_geojson_places, 'gpx': read_gpx_places}
+    imported = 0
+    skipped = []
+    batch = []
+    with DB.connection() as con:
+        cur = con.cursor()
+        DB.insert(cur, table_name='users', fields_list=['user_id', 'user_name'],
+                  values_list=[user_id, user_name], conflict_field_list=['user_id'])
+        for number, place in readers[import_format](file):
+            place = validate_imported_place(place)
+            if place is None:
+                skipped.append(number)
+                continue
+            if imported + len(batch) >= IMPORT_MAX_PLACES:
+                raise ValueError(f'В файле больше {IMPORT_MAX_PLACES} мест')
+            batch.append(place)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                DB.copy_places_from(cur, user_id, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            DB.copy_places_from(cur, user_id, batch)
+            imported += len(batch)
+    user_settings_cache.invalidate(user_id)
+    DB.mark_written(user_id)
+    reload_live_session(user_id)
+    return imported, skipped
+
+
+def validate_imported_place(place):
+    title, latitude, longitude = place
+    if not isinstance(title, str):
+        return None
+    try:
+        title = title.strip()
+        latitude = float(latitude) if latitude not in (None, '') else None
+        longitude = float(longitude) if longitude not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+    if not title or len(title) > TITLE_MAX_LENGTH or (latitude is None) != (longitude is None):
+        return None
+    if latitude is not None and not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return title, latitude, longitude
+
+
+def read_csv_places(file):
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        for row in reader:
+            yield reader.line_num, (row.get('title') or row.get('name'),
+                                    row.get('latitude') or row.get('lat'),
+                                    row.get('longitude') or row.get('lon') or row.get('lng'))
+    except (UnicodeDecodeError, csv.Error):
+        raise ValueError(INVALID_FILE_MESSAGE)
+
+
+def read_geojson_places(file):
+    try:
+        data = json.load(file)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError(INVALID_FILE_MESSAGE)
+    features = data.get('features', []) if isinstance(data, dict) else []
+    for number, feature in enumerate(features, start=1):
+        try:
+            properties = feature.get('properties') or {}
+            geometry = feature.get('geometry') or {}
+            coordinates = geometry.get('coordinates') if geometry.get('type') == 'Point' else None
+            longitude, latitude = coordinates[:2] if coordinates else (None, None)
+            yield number, (properties.get('title') or properties.get('name'), latitude, longitude)
+        except (AttributeError, TypeError, ValueError):
+            yield number, (None, None, None)
+
+
+def read_gpx_places(file):
+    number = 0
+    try:
+        for _, element in xml.etree.ElementTree.iterparse(file):
+            if element.tag.rsplit('}', 1)[-1] != 'wpt':
+                continue
+            number += 1
+            name = next((child.text for child in element if child.tag.rsplit('}', 1)[-1] == 'name'), None)
+            yield number, (name, element.get('lat'), element.get('lon'))
+            element.clear()
+    except xml.etree.ElementTree.ParseError:
+        raise ValueError(INVALID_FILE_MESSAGE)
+
+
+update_dispatcher = UpdateDispatcher(bot.process_new_updates,
+                                     workers=UPDATE_WORKERS,
+                                     queue_size=UPDATE_QUEUE_SIZE,
+                                     put_timeout=UPDATE_QUEUE_PUT_TIMEOUT)
+update_deduplicator = UpdateDeduplicator(max_size=UPDATE_DEDUP_SIZE,
+                                         ttl=UPDATE_DEDUP_TTL,
+                                         persistent=UPDATE_DEDUP_PERSISTENT)
 
 @server.route('/' + TOKEN, methods=['POST'])
 def getMessage():
     json_string = request.get_data().decode('utf-8')
     update = telebot.types.Update.de_json(json_string)
-    bot.process_new_updates([update])
+    if not update_deduplicator.register(update.update_id):
+        return "!", 200
+    if not update_dispatcher.submit(update):
+        update_deduplicator.forget(update.update_id)
+        return "!", 503
     return "!", 200
 
+@server.route('/metrics')
+def metrics():
+    lines = []
+    for metric in (handler_duration, handler_errors, db_query_duration, db_query_errors,
+                   api_request_duration, api_request_errors):
+        lines += metric.render()
+    for index, stats in enumerate(DB.replica_stats()):
+        for key, value in stats.items():
+            lines.append(f'bot_db_replica_pool_{key}{{replica="{index}"}} {value}')
+    for prefix, stats in (('bot_db_pool', DB.pool_stats()),
+                          ('bot_db_queries', DB.query_stats()),
+                          ('bot_update_queue', update_dispatcher.stats()),
+                          ('bot_update_dedup', update_deduplicator.stats()),
+                          ('bot_api_pipeline', send_pipeline.stats()),
+                          ('bot_admission', admission_control.stats()),
+                          ('bot_photo_ingest', photo_ingest.stats()),
+                          ('bot_user_settings_cache', user_settings_cache.stats()),
+                          ('bot_friend_cache_friends', friend_graph.stats()['friends']),
+                          ('bot_friend_cache_followers', friend_graph.stats()['followers'])):
+        for key, value in stats.items():
+            lines.append(f'{prefix}_{key} {value}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @server.route("/")
 def webhook():
-    bot.remove_webhook()
-    bot.set_webhook(url='https://geo-note-bot.herokuapp.com/' + TOKEN)
     return "!", 200
 
-bot.enable_save_next_step_handlers(delay=1)
-bot.load_next_step_handlers()
+
+@server.route('/ready')
+def ready():
+    is_ready = startup_complete.is_set() and not startup_failures
+    return Response(json.dumps({'ready': is_ready, 'timings': startup_timings, 'failed': startup_failures}),
+                    status=200 if is_ready else 503, mimetype='application/json')
+
+
+def ensure_webhook():
+    if not WEBHOOK_URL:
+        return False
+    url = WEBHOOK_URL + TOKEN
+    if bot.get_webhook_info().url == url:
+        return False
+    bot.set_webhook(url=url)
+    return True
+
+
+def warm_caches():
+    def select(con):
+        cur = con.cursor()
+        cur.execute("SELECT user_id, list_size, radius, friend_place_visible, nearest_count, nearest_max_radius FROM users "
+                    "WHERE user_id IN (SELECT user_id FROM places ORDER BY id DESC LIMIT %s)", (STARTUP_WARM_USERS,))
+        return cur.fetchall()
+    rows = DB.read(select)
+    for user_id, *settings in rows:
+        user_settings_cache.set(user_id, UserSettings(*settings))
+    return len(rows)
+
+
+def startup():
+    phases = [
+        ('database', DB.get_pool, True),
+        ('caches', warm_caches, False),
+        ('numpy', lambda: np.ndarray, True),
+        ('dispatcher', update_dispatcher.start, True),
+        ('photo cleanup', photo_ingest.start_cleanup, False),
+        ('webhook', ensure_webhook, False),
+    ]
+    for name, phase, required in phases:
+        start = time.perf_counter()
+        try:
+            phase()
+        except Exception:
+            logger.exception('Startup phase %s failed', name)
+            if required:
+                startup_failures.append(name)
+        startup_timings[name] = time.perf_counter() - start
+    startup_complete.set()
+    logger.info('Startup finished in %.3f s: %s', sum(startup_timings.values()),
+                ', '.join(f'{name} {seconds:.3f} s' for name, seconds in startup_timings.items()))
+
+CONVERSATION_STEPS = {step.__name__: step for step in [
+    add_name_step, add_photo_step, add_geoposition_step, add_save_in_database_step,
+    reset_delete_from_database_step, change_settings_new_value_input, change_settings_update,
+    search_query_step, delete_from_database, add_friend_to_database, delete_friend_from_database,
+    export_format_step, import_file_step,
+]}
+
+bot.next_step_backend = create_conversation_state_backend()
+
+startup_complete = threading.Event()
+startup_timings = {'import': time.perf_counter() - MODULE_LOAD_STARTED}
+startup_failures = []
+startup_lock = threading.Lock()
+startup_thread = None
+
+
+def start_background_startup():
+    global startup_thread
+    with startup_lock:
+        if startup_thread is not None:
+            return False
+        startup_thread = threading.Thread(target=startup, daemon=True)
+        startup_thread.start()
+        return True
+
+
+@server.before_request
+def ensure_started():
+    start_background_startup()
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    start_background_startup()
     server.run(host="0.0.0.0", port=int(os.environ.get('PORT', 5000)))
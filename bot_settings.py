@@ -4,6 +4,8 @@
 TOKEN = ''
 DEFAULT_LIST_OF_PLACES_SIZE = 10
 DEFAULT_RADIUS = 500.0
+DEFAULT_NEAREST_COUNT = 0
+NEAREST_MAX_COUNT = 50
 
 # Postgres settings
 USER = ''
@@ -11,3 +13,112 @@ PASSWORD = ''
 HOST = ''
 PORT = ''
 DATABASE = ''
+
+# Connection pool settings
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_CHECKOUT_TIMEOUT = 5.0
+POOL_HEALTH_CHECK_INTERVAL = 30.0
+
+# Photo storage settings
+PHOTO_KEEP_BLOB = False
+PHOTO_MIGRATION_CHAT_ID = None
+PHOTO_INGEST_WORKERS = 2
+PHOTO_THUMBNAIL_WIDTH = 320
+PHOTO_ORPHAN_TTL = 3600.0
+PHOTO_CLEANUP_INTERVAL = 600.0
+
+# User settings cache
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300.0
+
+# Webhook update processing
+UPDATE_WORKERS = 4
+UPDATE_QUEUE_SIZE = 100
+UPDATE_QUEUE_PUT_TIMEOUT = 0.5
+UPDATE_DEDUP_SIZE = 10000
+UPDATE_DEDUP_TTL = 3600.0
+UPDATE_DEDUP_PERSISTENT = False
+
+# Outbound Telegram API limits
+SEND_GLOBAL_RATE = 30.0
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 20
+SEND_GROUP_RATE = 20.0 / 60.0
+SEND_MAX_RETRIES = 3
+SEND_HTTP_POOL_SIZE = 16
+
+# Conversation state ('sqlite' or 'postgres')
+CONVERSATION_STATE_BACKEND = 'sqlite'
+CONVERSATION_STATE_FILE = './.handler-saves/state.sqlite'
+CONVERSATION_STATE_TTL = 3600.0
+
+# Search
+SEARCH_PAGE_SIZE = 10
+
+# List
+LIST_MAX_PAGE_SIZE = 50
+
+# Friend graph cache
+FRIEND_CACHE_SIZE = 10000
+FRIEND_CACHE_TTL = 300.0
+
+# Query builder
+DB_PREPARED_STATEMENTS = False
+DB_PREPARE_THRESHOLD = 5
+
+# Live location alerts
+GEOFENCE_CELL_SIZE = 1000.0
+GEOFENCE_EXIT_FACTOR = 1.2
+GEOFENCE_IDLE_TTL = 900.0
+GEOFENCE_SESSION_LIMIT = 10000
+
+# Startup
+WEBHOOK_URL = 'https://geo-note-bot.herokuapp.com/'
+STARTUP_WARM_USERS = 1000
+
+# Read replicas (libpq DSN strings, e.g. 'host=replica1 user=... dbname=...')
+REPLICA_DSNS = []
+REPLICA_STICKY_TTL = 10.0
+REPLICA_RETRY_INTERVAL = 30.0
+REPLICA_CHECKOUT_TIMEOUT = 0.5
+
+# Clustering of dense nearby results
+CLUSTER_THRESHOLD = 10
+CLUSTER_MAX_COUNT = 8
+CLUSTER_GRID_SIZE = 3
+CLUSTER_MIN_CELL_SIZE = 20.0
+CLUSTER_PAGE_SIZE = 10
+CLUSTER_CACHE_SIZE = 10000
+CLUSTER_CACHE_TTL = 600.0
+
+# Import and export
+EXPORT_FETCH_SIZE = 1000
+EXPORT_SPOOL_SIZE = 1024 * 1024
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_PLACES = 50000
+
+# Admission control
+ADMISSION_RATE = 1.0
+ADMISSION_BURST = 10.0
+ADMISSION_DEFAULT_COST = 1.0
+ADMISSION_COSTS = {
+    'send_welcome_message': 0.5,
+    'list_of_commands': 0.5,
+    'live_location_update': 0.2,
+    'get_places_within_radius': 3.0,
+    'list_command': 3.0,
+    'list_callback': 2.0,
+    'cluster_callback': 2.0,
+    'search': 2.0,
+    'search_callback': 2.0,
+    'export': 5.0,
+    'import_command': 5.0,
+}
+ADMISSION_HEAVY_HANDLERS = {
+    'get_places_within_radius', 'list_command', 'list_callback', 'cluster_callback', 'search_query_step',
+    'search_callback', 'export', 'export_format_step', 'import_file_step',
+}
+ADMISSION_HEAVY_LIMIT = 3
+ADMISSION_HEAVY_TIMEOUT = 2.0
+ADMISSION_NOTICE_INTERVAL = 10.0
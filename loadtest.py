@@ -0,0 +1,498 @@
+import argparse
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import psycopg2.extras
+import requests
+from telebot import apihelper
+from werkzeug.serving import make_server
+
+import bot
+from bot import DB, AdmissionControl, TokenBucket
+from bot_settings import TOKEN
+
+LOADTEST_USER_BASE = 900000000
+CENTER = (55.751244, 37.618423)
+SPREAD_DEGREES = 0.1
+WORDS = ['парк', 'кафе', 'музей', 'мост', 'сквер', 'театр', 'рынок', 'вокзал', 'собор', 'башня',
+         'park', 'cafe', 'museum', 'bridge', 'tower', 'market', 'station', 'garden']
+SCENARIOS = {'location': 5, 'list': 3, 'search': 2, 'add': 1, 'help': 1}
+FAKE_PHOTO = b'\xff\xd8\xff\xe0' + b'\0' * 2048 + b'\xff\xd9'
+
+
+class FakeTelegramAPI:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        apihelper.API_URL = f'http://127.0.0.1:{self.port}/bot{{0}}/{{1}}'
+        apihelper.FILE_URL = f'http://127.0.0.1:{self.port}/file/bot{{0}}/{{1}}'
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def call(self, method_name, params):
+        with self._lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method_name == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            return [self.message(params, photo=True) for _ in media]
+        if method_name.startswith('send') or method_name == 'editMessageText':
+            return self.message(params, photo=method_name == 'sendPhoto')
+        if method_name == 'getFile':
+            file_id = params.get('file_id', '')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(FAKE_PHOTO),
+                    'file_path': f'photos/{file_id}.jpg'}
+        if method_name == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'}
+        return True
+
+    def message(self, params, photo=False):
+        chat_id = int(params.get('chat_id', 0))
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'loadtest'},
+            'text': params.get('text', ''),
+        }
+        if photo:
+            file_id = f'photo{message["message_id"]}'
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 320, 'height': 240}]
+        return message
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def handle_request(self):
+                url = urllib.parse.urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if url.path.startswith('/file/'):
+                    self.respond(200, FAKE_PHOTO, 'image/jpeg')
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qsl(body.decode('utf-8')))
+                method_name = url.path.rsplit('/', 1)[-1]
+                result = api.call(method_name, params)
+                self.respond(200, json.dumps({'ok': True, 'result': result}).encode('utf-8'), 'application/json')
+
+            def respond(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def seed(users, places, friends, photo_share, rnd):
+    user_ids = [LOADTEST_USER_BASE + i for i in range(users)]
+    with DB.connection() as con:
+        cur = con.cursor()
+        cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s",
+                    (LOADTEST_USER_BASE, LOADTEST_USER_BASE + 10 ** 8))
+        psycopg2.extras.execute_values(
+            cur, "INSERT INTO users (user_id, user_name, friend_place_visible) VALUES %s",
+            [(user_id, f'user{user_id}', rnd.random() < 0.5) for user_id in user_ids], page_size=1000)
+        place_rows = []
+        for user_id in user_ids:
+            for _ in range(places):
+                latitude, longitude = random_point(rnd)
+                title = ' '.join(rnd.sample(WORDS, 2)) + f' {rnd.randrange(1000)}'
+                photo_file_id = f'seed{user_id}_{len(place_rows)}' if rnd.random() < photo_share else None
+                place_rows.append((user_id, title, photo_file_id, latitude, longitude))
+            if len(place_rows) >= 10000:
+                insert_places(cur, place_rows)
+                place_rows = []
+        insert_places(cur, place_rows)
+        friend_rows = []
+        for user_id in user_ids:
+            candidates = rnd.sample(user_ids, min(friends + 1, users))
+            friend_rows += [(user_id, friend_id) for friend_id in candidates if friend_id != user_id][:friends]
+        psycopg2.extras.execute_values(
+            cur, "INSERT INTO friends (user_id, friend_id) VALUES %s", friend_rows, page_size=1000)
+        cur.execute("ANALYZE users; ANALYZE places; ANALYZE friends")
+    return user_ids
+
+
+def insert_places(cur, rows):
+    if rows:
+        psycopg2.extras.execute_values(
+            cur, "INSERT INTO places (user_id, title, photo_file_id, latitude, longitude) VALUES %s",
+            rows, page_size=1000)
+
+
+def random_point(rnd):
+    return (CENTER[0] + rnd.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            CENTER[1] + rnd.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+
+
+class UpdateFactory:
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self._update_ids = itertools.count(int(time.time()) * 1000)
+        self._message_ids = itertools.count(1)
+
+    def message(self, user_id, **content):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'user{user_id}'},
+        }
+        message.update(content)
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def command(self, user_id, text):
+        return self.message(user_id, text=text, entities=[
+            {'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ', 1)[0])}])
+
+    def location(self, user_id):
+        latitude, longitude = random_point(self.rnd)
+        return self.message(user_id, location={'latitude': latitude, 'longitude': longitude})
+
+    def scenario(self, name, user_id):
+        if name == 'location':
+            return [('location', self.location(user_id))]
+        if name == 'list':
+            return [('list', self.command(user_id, f'/list {self.rnd.choice([5, 10, 20])}'))]
+        if name == 'search':
+            return [('search', self.command(user_id, '/search')),
+                    ('search:query', self.message(user_id, text=self.rnd.choice(WORDS)))]
+        if name == 'add':
+            file_id = f'upload{user_id}_{self.rnd.randrange(10 ** 6)}'
+            photo = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960}]
+            return [('add', self.command(user_id, '/add')),
+                    ('add:title', self.message(user_id, text=' '.join(self.rnd.sample(WORDS, 2)))),
+                    ('add:photo', self.message(user_id, photo=photo)),
+                    ('add:location', self.location(user_id)),
+                    ('add:save', self.message(user_id, text='Да'))]
+        return [('help', self.command(user_id, '/help'))]
+
+
+def generate_streams(user_ids, count, mix, rnd):
+    factory = UpdateFactory(rnd)
+    names, weights = zip(*mix.items())
+    streams = {user_id: [] for user_id in user_ids}
+    generated = 0
+    while generated < count:
+        user_id = rnd.choice(user_ids)
+        updates = factory.scenario(rnd.choices(names, weights)[0], user_id)
+        streams[user_id] += updates
+        generated += len(updates)
+    return {user_id: updates for user_id, updates in streams.items() if updates}
+
+
+def load_streams(filename):
+    streams = {}
+    with open(filename) as file:
+        for line in file:
+            if line.strip():
+                update = json.loads(line)
+                streams.setdefault(get_user_id(update), []).append((classify(update), update))
+    return streams
+
+
+def save_streams(filename, streams):
+    updates = sorted((update for _, update in itertools.chain(*streams.values())),
+                     key=lambda update: update['update_id'])
+    with open(filename, 'w') as file:
+        for update in updates:
+            file.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+
+def get_user_id(update):
+    for key in ('message', 'edited_message', 'callback_query'):
+        if key in update:
+            return update[key]['from']['id']
+    return None
+
+
+def classify(update):
+    if 'callback_query' in update:
+        return 'callback:' + update['callback_query'].get('data', '').split(':', 1)[0]
+    message = update.get('message') or update.get('edited_message') or {}
+    text = message.get('text', '')
+    if text.startswith('/'):
+        return text[1:].split(' ', 1)[0].split('@', 1)[0]
+    for content_type in ('location', 'photo', 'document'):
+        if content_type in message:
+            return content_type
+    return 'text'
+
+
+class Recorder:
+    def __init__(self):
+        self.sent_at = {}
+        self.kinds = {}
+        self.latencies = {}
+        self.ack_latencies = []
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def sent(self, update_id, kind):
+        with self._lock:
+            self.sent_at[update_id] = time.perf_counter()
+            self.kinds[update_id] = kind
+
+    def acked(self, status, latency):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.ack_latencies.append(latency)
+
+    def processed(self, update_id):
+        with self._lock:
+            sent_at = self.sent_at.pop(update_id, None)
+            if sent_at is not None:
+                kind = self.kinds.pop(update_id)
+                self.latencies.setdefault(kind, []).append(time.perf_counter() - sent_at)
+
+    def pending(self):
+        with self._lock:
+            return len(self.sent_at)
+
+
+class PoolSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stats = DB.pool_stats()
+            if stats:
+                self.samples.append(stats['in_use'])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(values):
+    return {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99), 'max': max(values) if values else 0.0}
+
+
+def instrument_dispatcher(recorder):
+    process = bot.update_dispatcher._process
+
+    def recorded_process(updates):
+        try:
+            process(updates)
+        finally:
+            for update in updates:
+                recorder.processed(update.update_id)
+
+    bot.update_dispatcher._process = recorded_process
+
+
+def disable_send_limits():
+    pipeline = bot.send_pipeline
+    pipeline._global_bucket = TokenBucket(10 ** 9, 10 ** 9)
+    pipeline.chat_rate = pipeline.chat_burst = pipeline.group_rate = 10 ** 9
+    pipeline._chat_buckets.clear()
+
+
+def disable_admission_limits():
+    limits = bot.admission_control
+    bot.admission_control = AdmissionControl(rate=10 ** 9, burst=10 ** 9, costs={}, default_cost=1,
+                                             heavy_handlers=set(), heavy_limit=limits.heavy_limit,
+                                             heavy_timeout=None, notice_interval=1.0)
+
+
+def replay(streams, url, concurrency, recorder):
+    session_local = threading.local()
+    user_ids = list(streams)
+    partitions = [user_ids[i::concurrency] for i in range(concurrency)]
+
+    def run_client(partition):
+        session_local.session = requests.Session()
+        queues = [list(streams[user_id]) for user_id in partition]
+        while any(queues):
+            for updates in queues:
+                if not updates:
+                    continue
+                kind, update = updates.pop(0)
+                recorder.sent(update['update_id'], kind)
+                start = time.perf_counter()
+                try:
+                    response = session_local.session.post(url, data=json.dumps(update).encode('utf-8'),
+                                                          headers={'Content-Type': 'application/json'})
+                    status = response.status_code
+                except requests.RequestException:
+                    status = 'error'
+                recorder.acked(status, time.perf_counter() - start)
+                if status != 200:
+                    recorder.processed(update['update_id'])
+
+    threads = [threading.Thread(target=run_client, args=(partition,), daemon=True)
+               for partition in partitions if partition]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def wait_drained(recorder, timeout):
+    deadline = time.monotonic() + timeout
+    while recorder.pending() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return recorder.pending()
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay update streams against the webhook with a fake Telegram API')
+    parser.add_argument('--users', type=int, default=100, help='Seeded users (N)')
+    parser.add_argument('--places', type=int, default=50, help='Places per seeded user (M)')
+    parser.add_argument('--friends', type=int, default=5, help='Friends per seeded user (F)')
+    parser.add_argument('--photo-share', type=float, default=0.5, help='Share of seeded places with a photo')
+    parser.add_argument('--skip-seed', action='store_true', help='Reuse the data seeded by a previous run')
+    parser.add_argument('--updates', type=int, default=2000, help='Synthetic updates to generate')
+    parser.add_argument('--mix', type=parse_mix, default=SCENARIOS,
+                        help='Scenario weights, e.g. location=5,list=3,search=2,add=1,help=1')
+    parser.add_argument('--replay', help='JSON lines file with recorded updates to replay instead')
+    parser.add_argument('--record', help='Save the generated updates as JSON lines for later replay')
+    parser.add_argument('--concurrency', type=int, default=8, help='Parallel webhook clients')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Fake Telegram API latency, s')
+    parser.add_argument('--send-limits', action='store_true', help='Keep the production outbound rate limits')
+    parser.add_argument('--admission-limits', action='store_true',
+                        help='Keep the production per-user admission control and heavy handler cap')
+    parser.add_argument('--dsn', help='Postgres DSN, defaults to bot_settings')
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the report JSON to this file')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    if args.dsn:
+        DB.connect = classmethod(lambda cls: psycopg2.connect(args.dsn))
+
+    if args.replay:
+        streams = load_streams(args.replay)
+    else:
+        if args.skip_seed:
+            user_ids = [LOADTEST_USER_BASE + i for i in range(args.users)]
+        else:
+            start = time.perf_counter()
+            user_ids = seed(args.users, args.places, args.friends, args.photo_share, rnd)
+            print(f'Seeded {args.users} users x {args.places} places x {args.friends} friends '
+                  f'in {time.perf_counter() - start:.1f} s')
+        streams = generate_streams(user_ids, args.updates, args.mix, rnd)
+        if args.record:
+            save_streams(args.record, streams)
+
+    api = FakeTelegramAPI(latency=args.api_latency)
+    api.start()
+    if not args.send_limits:
+        disable_send_limits()
+    if not args.admission_limits:
+        disable_admission_limits()
+    recorder = Recorder()
+    instrument_dispatcher(recorder)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    webhook = make_server('127.0.0.1', 0, bot.server, threaded=True)
+    threading.Thread(target=webhook.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{webhook.server_port}/{TOKEN}'
+
+    bot.WEBHOOK_URL = None
+    bot.start_background_startup()
+    bot.startup_complete.wait()
+    if bot.startup_failures:
+        raise SystemExit(f'Startup failed: {", ".join(bot.startup_failures)}')
+    sampler = PoolSampler(interval=0.05)
+    sampler.start()
+    total = sum(len(updates) for updates in streams.values())
+    start = time.perf_counter()
+    replay(streams, url, args.concurrency, recorder)
+    lost = wait_drained(recorder, args.drain_timeout)
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+    webhook.shutdown()
+    api.stop()
+
+    pool = DB.pool_stats()
+    report = {
+        'updates': total,
+        'lost': lost,
+        'elapsed': elapsed,
+        'throughput': (total - lost) / elapsed if elapsed else 0.0,
+        'webhook_status': {str(status): count for status, count in recorder.statuses.items()},
+        'webhook_ack': summarize(recorder.ack_latencies),
+        'commands': {kind: summarize(values) for kind, values in sorted(recorder.latencies.items())},
+        'db_pool': dict(pool, in_use_max=max(sampler.samples, default=0),
+                        in_use_avg=sum(sampler.samples) / len(sampler.samples) if sampler.samples else 0.0),
+        'dispatcher': bot.update_dispatcher.stats(),
+        'api_calls': dict(sorted(api.calls.items())),
+        'api_pipeline': bot.send_pipeline.stats(),
+        'admission': bot.admission_control.stats(),
+    }
+
+    print(f'{total} updates in {elapsed:.2f} s, {report["throughput"]:.1f} updates/s, {lost} not processed')
+    print(f'{"command":<24} {"count":>7} {"p50, ms":>9} {"p95, ms":>9} {"p99, ms":>9}')
+    for kind, stats in report['commands'].items():
+        print(f'{kind:<24} {stats["count"]:>7} {stats["p50"] * 1000:>9.1f} '
+              f'{stats["p95"] * 1000:>9.1f} {stats["p99"] * 1000:>9.1f}')
+    print(f'DB pool: {report["db_pool"].get("in_use_max")} of {report["db_pool"].get("max_size")} connections at peak, '
+          f'{report["db_pool"].get("waits", 0)} waits, {report["db_pool"].get("timeouts", 0)} timeouts')
+    print(f'Admission: {report["admission"]["shed_rate"]} shed by user rate, '
+          f'{report["admission"]["shed_busy"]} shed by heavy handler cap')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
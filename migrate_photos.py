@@ -0,0 +1,43 @@
+import argparse
+
+from bot import bot, DB
+from bot_settings import PHOTO_MIGRATION_CHAT_ID
+
+
+def migrate(chat_id, batch_size, drop_blobs):
+    migrated = 0
+    while True:
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("SELECT id, photo FROM places WHERE photo IS NOT NULL AND photo_file_id IS NULL ORDER BY id LIMIT %s",
+                        (batch_size,))
+            rows = cur.fetchall()
+        if not rows:
+            break
+        for place_id, photo in rows:
+            sent = bot.send_photo(chat_id, photo=bytes(photo), disable_notification=True)
+            with DB.connection() as con:
+                cur = con.cursor()
+                DB.update(cur, table_name='places', field_name='photo_file_id', new_value=sent.photo[-1].file_id,
+                          cond_field_list=['id'], cond_value_list=[place_id])
+            migrated += 1
+        print(f'Migrated {migrated} photos')
+
+    if drop_blobs:
+        with DB.connection() as con:
+            cur = con.cursor()
+            cur.execute("UPDATE places SET photo = NULL WHERE photo IS NOT NULL AND photo_file_id IS NOT NULL")
+            print(f'Dropped {cur.rowcount} photo blobs')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upload stored photo blobs to Telegram and save their file_id')
+    parser.add_argument('--chat-id', type=int, default=PHOTO_MIGRATION_CHAT_ID,
+                        help='Service chat the photos are uploaded to')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--drop-blobs', action='store_true',
+                        help='Clear the photo column for rows that already have a file_id')
+    args = parser.parse_args()
+    if args.chat_id is None:
+        parser.error('--chat-id or PHOTO_MIGRATION_CHAT_ID is required')
+    migrate(args.chat_id, args.batch_size, args.drop_blobs)
@@ -0,0 +1,219 @@
+import argparse
+import json
+import sys
+
+import psycopg2
+from psycopg2 import sql
+
+from bot_settings import *
+
+MIGRATIONS = [
+    (1, [
+        "CREATE TABLE IF NOT EXISTS users ("
+        "user_id BIGINT PRIMARY KEY, "
+        "user_name TEXT, "
+        f"list_size INTEGER NOT NULL DEFAULT {DEFAULT_LIST_OF_PLACES_SIZE}, "
+        f"radius DOUBLE PRECISION NOT NULL DEFAULT {DEFAULT_RADIUS}, "
+        "friend_place_visible BOOLEAN NOT NULL DEFAULT FALSE)",
+        "CREATE TABLE IF NOT EXISTS places ("
+        "id BIGSERIAL PRIMARY KEY, "
+        "user_id BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE, "
+        "title TEXT NOT NULL, "
+        "photo BYTEA, "
+        "latitude DOUBLE PRECISION, "
+        "longitude DOUBLE PRECISION)",
+        "CREATE TABLE IF NOT EXISTS friends ("
+        "user_id BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE, "
+        "friend_id BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE)",
+    ]),
+    (2, [
+        "ALTER TABLE places ADD COLUMN IF NOT EXISTS photo_file_id TEXT",
+        "CREATE TABLE IF NOT EXISTS processed_updates (update_id BIGINT PRIMARY KEY, received_at TIMESTAMP NOT NULL DEFAULT now())",
+        "CREATE TABLE IF NOT EXISTS conversation_state (chat_id BIGINT PRIMARY KEY, state TEXT NOT NULL, expires_at TIMESTAMP NOT NULL)",
+    ]),
+    (3, [
+        "CREATE INDEX IF NOT EXISTS places_user_id_id_idx ON places (user_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS places_user_id_coordinates_idx ON places (user_id, latitude, longitude)",
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS places_title_trgm_idx ON places USING gin (title gin_trgm_ops)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS friends_user_id_friend_id_key ON friends (user_id, friend_id)",
+        "CREATE INDEX IF NOT EXISTS friends_friend_id_idx ON friends (friend_id)",
+        "CREATE INDEX IF NOT EXISTS processed_updates_received_at_idx ON processed_updates (received_at)",
+        "CREATE INDEX IF NOT EXISTS conversation_state_expires_at_idx ON conversation_state (expires_at)",
+        "ALTER TABLE places DROP CONSTRAINT IF EXISTS places_user_id_fkey, "
+        "ADD CONSTRAINT places_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE",
+        "ALTER TABLE friends DROP CONSTRAINT IF EXISTS friends_user_id_fkey, "
+        "ADD CONSTRAINT friends_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE",
+        "ALTER TABLE friends DROP CONSTRAINT IF EXISTS friends_friend_id_fkey, "
+        "ADD CONSTRAINT friends_friend_id_fkey FOREIGN KEY (friend_id) REFERENCES users (user_id) ON DELETE CASCADE",
+    ]),
+    (4, [
+        f"ALTER TABLE users ADD COLUMN IF NOT EXISTS nearest_count INTEGER NOT NULL DEFAULT {DEFAULT_NEAREST_COUNT}, "
+        "ADD COLUMN IF NOT EXISTS nearest_max_radius DOUBLE PRECISION",
+        "CREATE EXTENSION IF NOT EXISTS cube",
+        "CREATE EXTENSION IF NOT EXISTS earthdistance",
+        "CREATE EXTENSION IF NOT EXISTS btree_gist",
+        "CREATE INDEX IF NOT EXISTS places_user_id_earth_idx ON places USING gist (user_id, ll_to_earth(latitude, longitude)) "
+        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL",
+    ]),
+    (5, [
+        "CREATE TABLE IF NOT EXISTS photos ("
+        "hash TEXT PRIMARY KEY, "
+        "file_id TEXT, "
+        "data BYTEA NOT NULL, "
+        "thumbnail BYTEA, "
+        "created_at TIMESTAMP NOT NULL DEFAULT now())",
+        "CREATE INDEX IF NOT EXISTS photos_file_id_idx ON photos (file_id)",
+        "ALTER TABLE places ADD COLUMN IF NOT EXISTS photo_hash TEXT REFERENCES photos (hash) ON DELETE SET NULL",
+    ]),
+    (6, [
+        "CREATE INDEX IF NOT EXISTS places_photo_hash_idx ON places (photo_hash) WHERE photo_hash IS NOT NULL",
+    ]),
+    (7, [
+        "CREATE INDEX IF NOT EXISTS photos_created_at_idx ON photos (created_at)",
+    ]),
+]
+
+MIGRATION_LOCK_ID = 7204518
+
+
+def get_version(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    cur.execute("SELECT max(version) FROM schema_version")
+    return cur.fetchone()[0] or 0
+
+
+def migrate(con):
+    with con.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        version = get_version(cur)
+        applied = []
+        for migration_version, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (migration_version,))
+            applied.append(migration_version)
+    con.commit()
+    return applied
+
+
+def hot_queries(DB):
+    user_id = 1
+    box = (55.7, 55.8, 37.5, 37.7)
+    return [
+        ('user settings', lambda cur: DB.select(cur, table_name='users', fields_list=['list_size', 'radius', 'friend_place_visible'],
+                                                cond_field_list=['user_id'], cond_value_list=[user_id])),
+        ('list page', lambda cur: DB.select_page(cur, table_name='places', fields_list=['id', 'title'], key_field='id',
+                                                 cond_field_list=['user_id'], cond_value_list=[user_id],
+                                                 after=1000, limit=11)),
+        ('nearby places', lambda cur: DB.select_within_box(cur, fields_list=['id', 'title'], owner_ids=[user_id], box=box)),
+        ('nearby places with friends', lambda cur: DB.select_within_box(cur, fields_list=['id', 'title'],
+                                                                        owner_ids=[user_id, 2, 3], box=box)),
+        ('nearest places', lambda cur: DB.select_nearest(cur, fields_list=['id', 'title'], owner_ids=[user_id, 2, 3],
+                                                         latitude=55.75, longitude=37.6, limit=10)),
+        ('nearest places within radius', lambda cur: DB.select_nearest(cur, fields_list=['id', 'title'], owner_ids=[user_id],
+                                                                       latitude=55.75, longitude=37.6, limit=10,
+                                                                       max_radius=5000)),
+        ('photo by file id', lambda cur: cur.execute("UPDATE photos SET created_at = now() WHERE file_id = %s RETURNING hash",
+                                                     ('AgACAgIAAxkBAAIB',))),
+        ('place photo', lambda cur: DB.select_photo(cur, place_id=1, thumbnail=True)),
+        ('search titles', lambda cur: DB.search_titles(cur, owner_ids=[user_id, 2, 3], text='park', limit=11)),
+        ('place details', lambda cur: DB.select_visible_place(cur, fields_list=['title'], owner_ids=[user_id], place_id=1)),
+        ('friend followers', lambda cur: DB.select(cur, table_name='friends', fields_list=['user_id'],
+                                                   cond_field_list=['friend_id'], cond_value_list=[user_id])),
+        ('delete place', lambda cur: DB.delete(cur, table_name='places', cond_field_list=['id', 'user_id', 'title'],
+                                               cond_value_list=[1, user_id, 'park'])),
+        ('reset user', lambda cur: DB.delete(cur, table_name='users', cond_field_list=['user_id'],
+                                             cond_value_list=[user_id])),
+        ('friends list', lambda cur: cur.execute("SELECT user_name, friend_id FROM friends JOIN users ON (friends.friend_id = users.user_id) WHERE friends.user_id = %s",
+                                                 (user_id,))),
+        ('delete friend', lambda cur: cur.execute("DELETE FROM friends USING users WHERE friends.friend_id = users.user_id AND friends.user_id = %s AND friends.friend_id = %s AND users.user_name = %s",
+                                                  (user_id, 2, 'Ivan'))),
+        ('export places', lambda cur: DB.select(cur, table_name='places', fields_list=['title', 'latitude', 'longitude'],
+                                                cond_field_list=['user_id'], cond_value_list=[user_id], order_field='id')),
+        ('warm caches', lambda cur: cur.execute("SELECT user_id, list_size, radius, friend_place_visible, nearest_count, nearest_max_radius FROM users "
+                                                "WHERE user_id IN (SELECT user_id FROM places ORDER BY id DESC LIMIT %s)", (1000,))),
+        ('orphaned photos', lambda cur: cur.execute("DELETE FROM photos WHERE created_at < now() - %s * interval '1 second' "
+                                                    "AND NOT EXISTS (SELECT 1 FROM places WHERE places.photo_hash = photos.hash)",
+                                                    (3600,))),
+        ('conversation state lookup', lambda cur: cur.execute("SELECT 1 FROM conversation_state WHERE chat_id = %s",
+                                                              (user_id,))),
+        ('conversation state', lambda cur: cur.execute("DELETE FROM conversation_state WHERE chat_id = %s RETURNING state, expires_at > now() AT TIME ZONE 'UTC'",
+                                                       (user_id,))),
+        ('expired conversation states', lambda cur: cur.execute("DELETE FROM conversation_state WHERE expires_at < now() AT TIME ZONE 'UTC'")),
+        ('expired processed updates', lambda cur: cur.execute("DELETE FROM processed_updates WHERE received_at < now() - %s * interval '1 second'",
+                                                              (3600,))),
+    ]
+
+
+class ExplainCursor:
+    def __init__(self, cur):
+        self.cur = cur
+        self.plans = []
+
+    def execute(self, query, values=None):
+        if isinstance(query, str):
+            query = sql.SQL(query)
+        self.cur.execute(sql.Composed([sql.SQL("EXPLAIN (FORMAT JSON) "), query]), values)
+        self.plans.append(self.cur.fetchone()[0][0]['Plan'])
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+def find_seq_scans(plan):
+    seq_scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        seq_scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        seq_scans += find_seq_scans(child)
+    return seq_scans
+
+
+def check_indexes(con, DB):
+    failures = []
+    with con.cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, run in hot_queries(DB):
+            explain_cur = ExplainCursor(cur)
+            run(explain_cur)
+            for plan in explain_cur.plans:
+                seq_scans = find_seq_scans(plan)
+                if seq_scans:
+                    failures.append((name, seq_scans, plan))
+    con.rollback()
+    return failures
+
+
+def connect():
+    return psycopg2.connect(user=USER, password=PASSWORD, host=HOST, port=PORT, database=DATABASE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database schema migrations and index checks')
+    parser.add_argument('command', choices=['migrate', 'check'])
+    parser.add_argument('--verbose', action='store_true', help='Print the plans of failed queries')
+    args = parser.parse_args()
+
+    con = connect()
+    try:
+        if args.command == 'migrate':
+            applied = migrate(con)
+            print(f'Applied migrations: {applied}' if applied else 'Schema is up to date')
+        else:
+            from bot import DB
+            failures = check_indexes(con, DB)
+            for name, seq_scans, plan in failures:
+                print(f'{name}: sequential scan on {", ".join(seq_scans)}')
+                if args.verbose:
+                    print(json.dumps(plan, indent=2))
+            if failures:
+                sys.exit(1)
+            print('All hot queries use indexes')
+    finally:
+        con.close()